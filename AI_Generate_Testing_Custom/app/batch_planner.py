@@ -0,0 +1,94 @@
+# Module dùng chung: các service giữ bản sao giống hệt (chỉ khác đường dẫn import) => sửa thì chép sang mọi bản;
+# AI_Service/tests/test_shared_modules.py kiểm tra các bản còn khớp nhau.
+import os
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+# ==========================================
+# Cấu hình chia batch
+# ==========================================
+BATCH_MIN = int(os.getenv("BATCH_MIN", "2"))
+BATCH_MAX = int(os.getenv("BATCH_MAX", "15"))
+# Chưa có số liệu quan sát thì dùng batch cố định như trước
+DEFAULT_BATCH_SIZE = int(os.getenv("DEFAULT_BATCH_SIZE", "5"))
+# Mục tiêu độ trễ của một lời gọi Gemini (giây) và trần output token của một lời gọi
+TARGET_BATCH_LATENCY_S = float(os.getenv("TARGET_BATCH_LATENCY_S", "12"))
+MAX_OUTPUT_TOKENS_PER_CALL = int(os.getenv("MAX_OUTPUT_TOKENS_PER_CALL", "6000"))
+# Chi phí cố định mỗi lời gọi (mạng + xử lý prompt), không phụ thuộc số câu
+PER_CALL_OVERHEAD_S = float(os.getenv("PER_CALL_OVERHEAD_S", "2.0"))
+# Số lời gọi song song tối đa cho một đề (giữ quota)
+MAX_BATCHES_PER_TEST = int(os.getenv("MAX_BATCHES_PER_TEST", "8"))
+# Trọng số EWMA cho mẫu mới
+EWMA_ALPHA = 0.2
+
+
+def split_even(total: int, parts: int) -> List[int]:
+    """Chia đều total thành parts phần, VD: (12, 3) => [4, 4, 4], (11, 3) => [4, 4, 3]"""
+    if total <= 0 or parts <= 0:
+        return []
+    base, extra = divmod(total, parts)
+    return [base + (1 if i < extra else 0) for i in range(parts)]
+
+
+class BatchPlanner:
+    """
+    Chọn kích thước batch theo số liệu quan sát được cho từng (loại câu hỏi, model):
+    - số output token / câu  -> không vượt MAX_OUTPUT_TOKENS_PER_CALL
+    - số giây / câu          -> mỗi lời gọi xong trong khoảng TARGET_BATCH_LATENCY_S
+    rồi chia đều số câu cho các batch (batch chậm nhất quyết định độ trễ của cả đề).
+    """
+
+    def __init__(self):
+        self._stats: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+    def record(self, question_type: str, model: str, n_questions: int,
+               elapsed_s: float, output_tokens: Optional[int] = None):
+        """Ghi nhận một batch đã xong (bỏ qua batch không sinh được câu nào)."""
+        if n_questions <= 0:
+            return
+        sec_per_q = max(0.05, (elapsed_s - PER_CALL_OVERHEAD_S) / n_questions)
+        st = self._stats.get((question_type, model))
+        if st is None:
+            st = self._stats[(question_type, model)] = {"sec_per_q": sec_per_q, "tokens_per_q": 0.0, "samples": 0}
+        else:
+            st["sec_per_q"] += EWMA_ALPHA * (sec_per_q - st["sec_per_q"])
+        if output_tokens:
+            tokens_per_q = output_tokens / n_questions
+            st["tokens_per_q"] = tokens_per_q if not st["tokens_per_q"] else \
+                st["tokens_per_q"] + EWMA_ALPHA * (tokens_per_q - st["tokens_per_q"])
+        st["samples"] += 1
+
+    def batch_size(self, question_type: str, model: str) -> int:
+        st = self._stats.get((question_type, model))
+        if not st:
+            return DEFAULT_BATCH_SIZE
+        size = (TARGET_BATCH_LATENCY_S - PER_CALL_OVERHEAD_S) / st["sec_per_q"]
+        if st["tokens_per_q"]:
+            size = min(size, MAX_OUTPUT_TOKENS_PER_CALL / st["tokens_per_q"])
+        return max(BATCH_MIN, min(BATCH_MAX, int(size)))
+
+    def plan(self, num_questions: int, question_type: str, model: str) -> List[int]:
+        """Danh sách kích thước batch cho num_questions câu, VD: 40 câu MCQ => [10, 10, 10, 10]"""
+        if num_questions <= 0:
+            return []
+        size = self.batch_size(question_type, model)
+        n_batches = math.ceil(num_questions / size)
+        if n_batches > MAX_BATCHES_PER_TEST:
+            # Ưu tiên quota: batch to hơn (có thể vượt BATCH_MAX) thay vì thêm lời gọi
+            n_batches = MAX_BATCHES_PER_TEST
+        return split_even(num_questions, n_batches)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            f"{qtype}|{model}": {
+                "samples": st["samples"],
+                "sec_per_question": round(st["sec_per_q"], 2),
+                "tokens_per_question": round(st["tokens_per_q"], 1),
+                "batch_size": self.batch_size(qtype, model),
+            }
+            for (qtype, model), st in self._stats.items()
+        }
+
+
+# Planner dùng chung của process
+planner = BatchPlanner()
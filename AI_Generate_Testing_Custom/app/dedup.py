@@ -0,0 +1,138 @@
+# Module dùng chung: các service giữ bản sao giống hệt (chỉ khác đường dẫn import) => sửa thì chép sang mọi bản;
+# AI_Service/tests/test_shared_modules.py kiểm tra các bản còn khớp nhau.
+import os
+import re
+import zlib
+import random
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# ==========================================
+# Cấu hình phát hiện câu gần trùng (MinHash + LSH)
+# ==========================================
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# Độ giống (Jaccard ước lượng trên shingle ký tự) từ ngưỡng này trở lên thì coi là trùng
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+# Số hàm băm = DEDUP_BANDS * DEDUP_ROWS; 16 x 4 => cặp có Jaccard ~0.5 trở lên mới thành ứng viên
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "16"))
+DEDUP_ROWS = int(os.getenv("DEDUP_ROWS", "4"))
+SHINGLE_SIZE = 5
+
+# Mỗi "hoán vị" MinHash là XOR hash của shingle với một mặt nạ ngẫu nhiên: rẻ hơn nhiều so với
+# (a*h + b) mod p trên số nguyên lớn mà vẫn bám sát Jaccard thật => kiểm tra một câu < 1ms.
+# Seed cố định: chữ ký ổn định giữa các process / lần chạy.
+_rng = random.Random(20240601)
+_MASKS: List[int] = [_rng.getrandbits(32) for _ in range(DEDUP_BANDS * DEDUP_ROWS)]
+
+# Số liệu chung của mọi index trong process
+stats = {"checked": 0, "rejected": 0}
+
+
+def normalize_text(text: str) -> str:
+    """Chữ thường, bỏ dấu câu / ký hiệu chỗ trống (___), gộp khoảng trắng."""
+    text = re.sub(r"[^\w\s]|_", " ", (text or "").lower())
+    return " ".join(text.split())
+
+
+def question_text(question: dict) -> str:
+    """Nội dung dùng để so trùng: đề bài + các lựa chọn (câu cùng đề bài nhưng khác đáp án vẫn là câu khác)."""
+    text = question.get("question") or question.get("text") or ""
+    options = question.get("options") or []
+    return " ".join([text, *map(str, options)])
+
+
+def signature(text: str) -> Tuple[int, ...]:
+    norm = normalize_text(text)
+    if len(norm) <= SHINGLE_SIZE:
+        shingles = {norm}
+    else:
+        shingles = {norm[i:i + SHINGLE_SIZE] for i in range(len(norm) - SHINGLE_SIZE + 1)}
+    hashes = [zlib.crc32(s.encode()) for s in shingles]
+    return tuple(min(h ^ m for h in hashes) for m in _MASKS)
+
+
+def signatures(texts: List[str]) -> List[Tuple[int, ...]]:
+    """Chữ ký của nhiều câu một lần (hàm top-level: gửi được sang process pool)."""
+    return [signature(t) for t in texts]
+
+
+def similarity(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class NearDuplicateIndex:
+    """
+    Index MinHash/LSH trong bộ nhớ: kiểm tra một câu mới chỉ đụng tới các câu chung "band",
+    không so với toàn bộ kho. Giới hạn `max_items` (bỏ câu cũ nhất khi đầy).
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, max_items: int = 0):
+        self.threshold = threshold
+        self.max_items = max_items
+        self._sigs: "OrderedDict[Hashable, Tuple[int, ...]]" = OrderedDict()
+        self._bands: Dict[Tuple[int, Tuple[int, ...]], set] = {}
+
+    def __len__(self):
+        return len(self._sigs)
+
+    def _band_keys(self, sig: Tuple[int, ...]):
+        return [(b, sig[b * DEDUP_ROWS:(b + 1) * DEDUP_ROWS]) for b in range(DEDUP_BANDS)]
+
+    def find(self, text: str, sig: Optional[Tuple[int, ...]] = None) -> Optional[Hashable]:
+        """Key của câu gần trùng đã có trong index, hoặc None."""
+        sig = sig or signature(text)
+        candidates = set()
+        for band in self._band_keys(sig):
+            candidates |= self._bands.get(band, set())
+        for key in candidates:
+            if similarity(sig, self._sigs[key]) >= self.threshold:
+                return key
+        return None
+
+    def add(self, key: Hashable, text: str, sig: Optional[Tuple[int, ...]] = None):
+        sig = sig or signature(text)
+        if key in self._sigs:
+            self.remove(key)
+        self._sigs[key] = sig
+        for band in self._band_keys(sig):
+            self._bands.setdefault(band, set()).add(key)
+        if self.max_items and len(self._sigs) > self.max_items:
+            self.remove(next(iter(self._sigs)))
+
+    def remove(self, key: Hashable):
+        sig = self._sigs.pop(key, None)
+        if sig is None:
+            return
+        for band in self._band_keys(sig):
+            keys = self._bands.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._bands[band]
+
+    def add_if_new(self, key: Hashable, text: str) -> bool:
+        """Thêm câu nếu chưa có câu gần trùng; False nghĩa là câu bị loại."""
+        if not DEDUP_ENABLED:
+            return True
+        stats["checked"] += 1
+        sig = signature(text)
+        if self.find(text, sig) is not None:
+            stats["rejected"] += 1
+            return False
+        self.add(key, text, sig)
+        return True
+
+
+def unique_questions(questions: List[dict], index: Optional[NearDuplicateIndex] = None) -> List[dict]:
+    """Lọc các câu gần trùng (với nhau và với các câu đã có trong `index`), giữ thứ tự."""
+    index = index if index is not None else NearDuplicateIndex()
+    return [q for q in questions if index.add_if_new(question_text(q), question_text(q))]
+
+
+def get_stats() -> dict:
+    return {
+        **stats,
+        "enabled": DEDUP_ENABLED,
+        "threshold": DEDUP_THRESHOLD,
+        "reject_rate": round(stats["rejected"] / stats["checked"], 3) if stats["checked"] else 0.0,
+    }
@@ -0,0 +1,203 @@
+# Module dùng chung: các service giữ bản sao giống hệt (chỉ khác đường dẫn import) => sửa thì chép sang mọi bản;
+# AI_Service/tests/test_shared_modules.py kiểm tra các bản còn khớp nhau.
+import os
+import time
+import random
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# ==========================================
+# Cấu hình (0 = không giới hạn)
+# ==========================================
+# Trần số lời gọi Gemini chạy đồng thời trong một worker
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "64"))
+# Ngân sách theo quota của API key
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+# Số lời gọi tối đa được phép xếp hàng chờ; vượt quá thì từ chối ngay
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "500"))
+# Retry khi Gemini báo quá tải (429 / 503)
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+
+RETRYABLE_STATUS = {429, 503}
+
+
+class SchedulerQueueFull(RuntimeError):
+    """Hàng chờ Gemini đã đầy; caller nên trả lỗi quá tải thay vì chờ vô hạn."""
+
+
+class TokenBucket:
+    """Token bucket nạp lại liên tục theo `per_minute`; các caller được phục vụ theo thứ tự FIFO."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+_rpm_bucket: Optional[TokenBucket] = TokenBucket(GEMINI_RPM) if GEMINI_RPM > 0 else None
+_tpm_bucket: Optional[TokenBucket] = TokenBucket(GEMINI_TPM) if GEMINI_TPM > 0 else None
+
+_stats = {
+    "queued": 0,        # đang chờ slot / ngân sách
+    "active": 0,        # đang gọi Gemini
+    "calls": 0,
+    "retries": 0,
+    "throttled": 0,     # số lần nhận 429/503
+    "rejected": 0,      # bị từ chối vì hàng chờ đầy
+    "failed": 0,
+    "max_queued": 0,
+}
+
+
+def estimate_tokens(prompt: str, expected_output_tokens: int = 0) -> int:
+    """Ước lượng thô (~4 ký tự / token) để trừ vào ngân sách TPM."""
+    return len(prompt) // 4 + expected_output_tokens
+
+
+def status_of(exc: BaseException) -> Optional[int]:
+    """Lấy HTTP status từ lỗi của google-genai (APIError.code) hoặc httpx (response.status_code)."""
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(exc, "response", None)
+    code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    return status_of(exc) in RETRYABLE_STATUS
+
+
+def _backoff(attempt: int) -> float:
+    # Exponential backoff + full jitter
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt)))
+
+
+@asynccontextmanager
+async def slot(est_tokens: int = 0):
+    """
+    Chờ tới lượt (concurrency + RPM + TPM) rồi giữ slot trong suốt khối lệnh.
+    Ném SchedulerQueueFull nếu hàng chờ đã đầy.
+    """
+    if GEMINI_MAX_QUEUE and _stats["queued"] >= GEMINI_MAX_QUEUE:
+        _stats["rejected"] += 1
+        raise SchedulerQueueFull(f"Gemini queue is full ({GEMINI_MAX_QUEUE} waiting)")
+
+    _stats["queued"] += 1
+    _stats["max_queued"] = max(_stats["max_queued"], _stats["queued"])
+    try:
+        await _semaphore.acquire()
+        try:
+            if _rpm_bucket:
+                await _rpm_bucket.acquire(1)
+            if _tpm_bucket and est_tokens:
+                await _tpm_bucket.acquire(est_tokens)
+        except BaseException:
+            _semaphore.release()
+            raise
+    finally:
+        _stats["queued"] -= 1
+
+    _stats["active"] += 1
+    _stats["calls"] += 1
+    try:
+        yield
+    finally:
+        _stats["active"] -= 1
+        _semaphore.release()
+
+
+def _mark_started(timing: Optional[dict]):
+    # Thời điểm lời gọi thật sự bắt đầu (đã có slot, sau mọi lần chờ hàng đợi / backoff)
+    if timing is not None:
+        timing["started"] = time.monotonic()
+
+
+async def run(call: Callable[[], Awaitable[T]], est_tokens: int = 0, timing: Optional[dict] = None) -> T:
+    """
+    Chạy một lời gọi Gemini qua scheduler, retry với backoff khi gặp 429/503.
+    `call` là hàm không tham số trả về awaitable, VD:
+        await run(lambda: client.aio.models.generate_content(model=..., contents=...), est_tokens=...)
+    Truyền `timing` (dict) để nhận timing["started"] = lúc lấy được slot của lần gọi cuối:
+    đo độ trễ sinh câu không lẫn thời gian chờ hàng đợi / backoff.
+    """
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            async with slot(est_tokens):
+                _mark_started(timing)
+                return await call()
+        except SchedulerQueueFull:
+            raise
+        except Exception as e:
+            if not _is_retryable(e) or attempt >= GEMINI_MAX_RETRIES:
+                _stats["failed"] += 1
+                raise
+            _stats["throttled"] += 1
+            _stats["retries"] += 1
+            delay = _backoff(attempt)
+            print(f"⏳ Gemini quá tải ({status_of(e)}), thử lại sau {delay:.1f}s (lần {attempt + 1})")
+            await asyncio.sleep(delay)
+
+
+async def stream(open_stream: Callable[[], Awaitable[AsyncIterator[Any]]], est_tokens: int = 0,
+                 timing: Optional[dict] = None):
+    """
+    Phiên bản cho lời gọi stream: giữ slot trong suốt quá trình đọc stream.
+    Chỉ retry khi lỗi xảy ra trước chunk đầu tiên (đã yield dữ liệu thì không thể gọi lại).
+    `timing` như ở run().
+    """
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        started = False
+        try:
+            async with slot(est_tokens):
+                _mark_started(timing)
+                async for chunk in await open_stream():
+                    started = True
+                    yield chunk
+            return
+        except SchedulerQueueFull:
+            raise
+        except Exception as e:
+            if started or not _is_retryable(e) or attempt >= GEMINI_MAX_RETRIES:
+                _stats["failed"] += 1
+                raise
+            _stats["throttled"] += 1
+            _stats["retries"] += 1
+            delay = _backoff(attempt)
+            print(f"⏳ Gemini quá tải ({status_of(e)}), thử lại sau {delay:.1f}s (lần {attempt + 1})")
+            await asyncio.sleep(delay)
+
+
+def get_stats() -> dict[str, Any]:
+    return {
+        **_stats,
+        "max_concurrency": GEMINI_MAX_CONCURRENCY,
+        "max_queue": GEMINI_MAX_QUEUE,
+        "rpm_limit": GEMINI_RPM,
+        "tpm_limit": GEMINI_TPM,
+        "rpm_available": round(_rpm_bucket.tokens, 1) if _rpm_bucket else None,
+        "tpm_available": round(_tpm_bucket.tokens, 1) if _tpm_bucket else None,
+    }
@@ -0,0 +1,223 @@
+# inventory.py
+# Giữ kho câu hỏi "ấm" trong Mongo: mỗi bucket (level, tag, type) luôn có ít nhất LOW_WATER câu,
+# phần thiếu được sinh ngầm bằng Gemini lúc service rảnh, để /tests/custom chỉ còn là một truy vấn DB.
+
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+# ==========================================
+# Cấu hình
+# ==========================================
+INVENTORY_ENABLED = os.getenv("INVENTORY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Dưới mức này thì bucket cần bổ sung; bổ sung tới INVENTORY_TARGET
+INVENTORY_LOW_WATER = int(os.getenv("INVENTORY_LOW_WATER", "20"))
+INVENTORY_TARGET = int(os.getenv("INVENTORY_TARGET", "40"))
+# Số câu mỗi lần gọi Gemini khi bổ sung
+INVENTORY_BATCH = int(os.getenv("INVENTORY_BATCH", "10"))
+# Chỉ sinh khi không có request nào trong khoảng này (giây) => không tranh quota với request thật
+INVENTORY_IDLE_S = float(os.getenv("INVENTORY_IDLE_S", "3"))
+# Chu kỳ kiểm tra tồn kho (giây)
+INVENTORY_INTERVAL_S = float(os.getenv("INVENTORY_INTERVAL_S", "30"))
+# Bucket bổ sung xong mà số câu trong DB không tăng (VD câu bị ghi đè do trùng id) thì tạm bỏ qua
+# trong khoảng này (giây) thay vì đốt quota Gemini ở mỗi chu kỳ
+INVENTORY_STALL_BACKOFF_S = float(os.getenv("INVENTORY_STALL_BACKOFF_S", "600"))
+# Trần số bucket theo dõi từ request (ngoài bucket seed): đầy thì bỏ bucket lâu nhất không được dùng;
+# bucket không được request nào dùng trong INVENTORY_BUCKET_TTL_S giây cũng bị bỏ
+INVENTORY_MAX_BUCKETS = int(os.getenv("INVENTORY_MAX_BUCKETS", "200"))
+INVENTORY_BUCKET_TTL_S = float(os.getenv("INVENTORY_BUCKET_TTL_S", "86400"))
+# Số câu tối đa được sinh trong một chu kỳ bổ sung (phần còn lại để chu kỳ sau)
+INVENTORY_MAX_PER_CYCLE = int(os.getenv("INVENTORY_MAX_PER_CYCLE", "100"))
+# Bucket khởi tạo sẵn, VD: "B1:present_perfect:mcq,B1:business_vocab:gap" (tag rỗng = không lọc tag)
+INVENTORY_SEED = os.getenv("INVENTORY_SEED", "")
+
+Bucket = Tuple[str, str, str]  # (level, tag, type)
+# generate(level, tag, type, count) -> số câu đã lưu
+Generator = Callable[[str, str, str, int], Awaitable[int]]
+
+
+def bucket_query(bucket: Bucket) -> dict:
+    level, tag, qtype = bucket
+    query = {"level": level, "type": qtype}
+    if tag:
+        query["tags"] = tag
+    return query
+
+
+def parse_seed(seed: str) -> list:
+    buckets = []
+    for item in seed.split(","):
+        parts = [p.strip() for p in item.split(":")]
+        if len(parts) == 3 and parts[0] and parts[2]:
+            buckets.append(tuple(parts))
+    return buckets
+
+
+class QuestionInventory:
+    """
+    Theo dõi tồn kho từng bucket (level, tag, type) và bổ sung ngầm.
+    - Request gọi `note_demand()` với các bucket nó cần => bucket được theo dõi, mốc "bận" được cập nhật.
+      Chỉ nhận tag rỗng, tag của seed hoặc tag đã có trong ngân hàng (tag tùy ý từ client không làm phình kho);
+      số bucket từ request bị chặn bởi INVENTORY_MAX_BUCKETS (LRU) và INVENTORY_BUCKET_TTL_S.
+    - Vòng nền kiểm tra tồn kho theo chu kỳ; bucket dưới LOW_WATER được bổ sung (thiếu nhiều làm trước),
+      mỗi batch chỉ chạy khi service đã rảnh INVENTORY_IDLE_S giây; mỗi chu kỳ sinh tối đa INVENTORY_MAX_PER_CYCLE câu.
+    """
+
+    def __init__(self, db, generate: Generator):
+        self.db = db
+        self.generate = generate
+        self._seed = parse_seed(INVENTORY_SEED)
+        self._buckets: Dict[Bucket, int] = {b: -1 for b in self._seed}  # -1 = chưa đếm
+        # Bucket từ request -> thời điểm (monotonic) được dùng gần nhất, cũ nhất ở đầu
+        self._demand: "OrderedDict[Bucket, float]" = OrderedDict()
+        # Tag hợp lệ: tag của seed + tag đã có trong ngân hàng (nạp lại mỗi chu kỳ)
+        self._known_tags: Set[str] = {b[1] for b in self._seed}
+        self._stalled: Dict[Bucket, float] = {}  # bucket -> thời điểm (monotonic) được thử bổ sung lại
+        self._last_request = 0.0
+        self._active_requests = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"checks": 0, "refills": 0, "generated": 0, "failed": 0, "served_short": 0, "stalled": 0,
+                      "ignored": 0, "evicted": 0, "budget_exhausted": 0}
+
+    # --- Phía request ---
+    def note_demand(self, buckets, short: bool = False):
+        """Ghi nhận bucket được request dùng; short=True nếu DB không đủ câu (đánh thức vòng nền)."""
+        now = self._last_request = time.monotonic()
+        for b in buckets:
+            if b in self._seed:
+                continue
+            if b[1] and b[1] not in self._known_tags:
+                self.stats["ignored"] += 1
+                continue
+            self._demand[b] = now
+            self._demand.move_to_end(b)
+            self._buckets.setdefault(b, -1)
+        while len(self._demand) > INVENTORY_MAX_BUCKETS:
+            self._forget(next(iter(self._demand)))
+        if short:
+            self.stats["served_short"] += 1
+            self._wakeup.set()
+
+    def _forget(self, bucket: Bucket):
+        self._demand.pop(bucket, None)
+        self._buckets.pop(bucket, None)
+        self._stalled.pop(bucket, None)
+        self.stats["evicted"] += 1
+
+    def _expire(self):
+        deadline = time.monotonic() - INVENTORY_BUCKET_TTL_S
+        while self._demand:
+            bucket, last_used = next(iter(self._demand.items()))
+            if last_used > deadline:
+                break
+            self._forget(bucket)
+
+    def request_started(self):
+        self._active_requests += 1
+        self._last_request = time.monotonic()
+
+    def request_finished(self):
+        self._active_requests -= 1
+        self._last_request = time.monotonic()
+
+    # --- Vòng nền ---
+    def start(self):
+        if INVENTORY_ENABLED and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _wait_idle(self):
+        while True:
+            idle_for = time.monotonic() - self._last_request
+            if self._active_requests == 0 and idle_for >= INVENTORY_IDLE_S:
+                return
+            await asyncio.sleep(max(0.2, INVENTORY_IDLE_S - idle_for))
+
+    async def count(self, bucket: Bucket) -> int:
+        n = await self.db.questions.count_documents(bucket_query(bucket), limit=INVENTORY_TARGET)
+        if bucket in self._buckets:  # bucket có thể vừa bị bỏ khỏi LRU trong lúc chờ DB
+            self._buckets[bucket] = n
+        return n
+
+    async def refresh_known_tags(self):
+        tags = await self.db.questions.distinct("tags")
+        self._known_tags = {t for t in tags if isinstance(t, str)} | {b[1] for b in self._seed}
+
+    async def refill_once(self):
+        """Một lượt: đếm lại mọi bucket, bổ sung các bucket dưới LOW_WATER (tối đa INVENTORY_MAX_PER_CYCLE câu)."""
+        self.stats["checks"] += 1
+        await self.refresh_known_tags()
+        self._expire()
+        for b in list(self._buckets):
+            await self.count(b)
+        now = time.monotonic()
+        low = sorted((n, b) for b, n in self._buckets.items()
+                     if n < INVENTORY_LOW_WATER and self._stalled.get(b, 0.0) <= now)
+        budget = INVENTORY_MAX_PER_CYCLE
+        for n, bucket in low:
+            if budget <= 0:
+                self.stats["budget_exhausted"] += 1
+                break
+            generated = 0
+            missing = INVENTORY_TARGET - n
+            while missing > 0 and budget > 0:
+                await self._wait_idle()
+                count = min(INVENTORY_BATCH, missing, budget)
+                try:
+                    saved = await self.generate(*bucket, count)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"⚠️ Bổ sung kho {bucket} lỗi: {e}")
+                    break
+                if saved <= 0:
+                    break
+                missing -= saved
+                budget -= saved
+                generated += saved
+                self.stats["generated"] += saved
+            self.stats["refills"] += 1
+            if generated > 0 and await self.count(bucket) <= n:
+                # Đã sinh và lưu mà tồn kho không tăng => câu mới đang ghi đè câu cũ; dừng bucket này một thời gian
+                self._stalled[bucket] = time.monotonic() + INVENTORY_STALL_BACKOFF_S
+                self.stats["stalled"] += 1
+                print(f"⚠️ Bổ sung kho {bucket}: đã lưu {generated} câu nhưng tồn kho vẫn {n}, tạm dừng bucket")
+            else:
+                self._stalled.pop(bucket, None)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Vòng bổ sung kho lỗi: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=INVENTORY_INTERVAL_S)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "enabled": INVENTORY_ENABLED,
+            "low_water": INVENTORY_LOW_WATER,
+            "target": INVENTORY_TARGET,
+            "max_buckets": INVENTORY_MAX_BUCKETS,
+            "max_per_cycle": INVENTORY_MAX_PER_CYCLE,
+            "known_tags": len(self._known_tags),
+            "buckets": {":".join(b): n for b, n in self._buckets.items()},
+            "stalled_buckets": [":".join(b) for b, t in self._stalled.items() if t > time.monotonic()],
+        }
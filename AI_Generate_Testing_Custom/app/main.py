@@ -2,6 +2,8 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from app.render_service import render_test
+from app import gemini_scheduler
+from app.batch_planner import planner
 
 app = FastAPI(title="AI Engine - English Test Generator")
 
@@ -41,3 +43,11 @@ async def generate_test_endpoint(req: TestRequest):
         return {"status": "success", "data": result}
     except Exception as e:
         return {"status": "error", "message": str(e)}
+
+@app.get("/metrics/gemini-scheduler")
+async def gemini_scheduler_metrics():
+    return gemini_scheduler.get_stats()
+
+@app.get("/metrics/batch-planner")
+async def batch_planner_metrics():
+    return planner.get_stats()
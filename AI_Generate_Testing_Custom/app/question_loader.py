@@ -0,0 +1,65 @@
+# question_loader.py
+# Đề chỉ lưu question_ids; loader này nạp câu hỏi theo lô (một truy vấn $in cho các id còn thiếu)
+# và giữ câu hỏi nóng trong LRU của process (câu hỏi không đổi sau khi tạo).
+
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+QUESTION_CACHE_SIZE = int(os.getenv("QUESTION_CACHE_SIZE", "5000"))
+
+
+class QuestionLoader:
+    def __init__(self, collection, max_items: int = QUESTION_CACHE_SIZE, projection: Optional[dict] = None):
+        self.collection = collection
+        self.max_items = max_items
+        self.projection = projection or {"_id": 0}
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "queries": 0, "evictions": 0}
+
+    def prime(self, questions: Iterable[dict]):
+        """Đưa câu hỏi vừa chọn / vừa sinh vào cache (tránh đọc lại ngay sau khi tạo đề)."""
+        for q in questions:
+            if q.get("id"):
+                self._put(q["id"], {k: v for k, v in q.items() if k != "_id"})
+
+    def invalidate(self, question_id: str):
+        self._cache.pop(question_id, None)
+
+    def _put(self, qid: str, doc: dict):
+        self._cache[qid] = doc
+        self._cache.move_to_end(qid)
+        while len(self._cache) > self.max_items:
+            self._cache.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def load(self, ids: List[str]) -> List[dict]:
+        """Trả về câu hỏi theo đúng thứ tự ids; id không còn trong DB thì bỏ qua."""
+        found: Dict[str, dict] = {}
+        missing = []
+        for qid in dict.fromkeys(ids):
+            doc = self._cache.get(qid)
+            if doc is None:
+                missing.append(qid)
+            else:
+                self._cache.move_to_end(qid)
+                found[qid] = doc
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(missing)
+
+        if missing:
+            self.stats["queries"] += 1
+            docs = await self.collection.find({"id": {"$in": missing}}, self.projection).to_list(length=len(missing))
+            for doc in docs:
+                self._put(doc["id"], doc)
+                found[doc["id"]] = doc
+        return [found[qid] for qid in ids if qid in found]
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "items": len(self._cache),
+            "max_items": self.max_items,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
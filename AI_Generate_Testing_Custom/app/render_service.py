@@ -2,33 +2,47 @@
 
 import os
 import json
+import time
 import asyncio
 from dotenv import load_dotenv
 from google import genai
 from .prompts import generate_test_prompt
+from . import gemini_scheduler
+from .batch_planner import planner
 
 load_dotenv(override=True)
 
 api_key = os.getenv("GEMINI_API_KEY")
 model_name = os.getenv("MODEL_NAME", "gemini-2.5-flash")
 client = genai.Client(api_key=api_key)
+# Ước lượng output token mỗi câu hỏi (để trừ ngân sách TPM của scheduler)
+OUTPUT_TOKENS_PER_QUESTION = 250
 
 # Hàm phụ để gọi 1 batch nhỏ
 async def generate_batch(batch_size, **kwargs):
     # Cập nhật số lượng câu hỏi cho prompt này
     kwargs['num_questions'] = batch_size
     prompt = generate_test_prompt(**kwargs)
-    
+    timing = {}  # scheduler ghi timing["started"] khi lấy được slot (không tính chờ hàng đợi / backoff)
+
     try:
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=model_name,
-            contents=prompt
+        # Đi qua scheduler chung: giới hạn đồng thời, RPM/TPM, retry 429/503
+        response = await gemini_scheduler.run(
+            lambda: client.aio.models.generate_content(model=model_name, contents=prompt),
+            est_tokens=gemini_scheduler.estimate_tokens(prompt, OUTPUT_TOKENS_PER_QUESTION * batch_size),
+            timing=timing,
         )
         text = response.text.strip()
         if text.startswith("```"):
             text = text.strip("`").replace("json", "", 1).strip()
-        return json.loads(text).get("data", [])
+        questions = json.loads(text).get("data", [])
+
+        # Số liệu để planner chọn kích thước batch cho các lần sau
+        usage = getattr(response, "usage_metadata", None)
+        output_tokens = getattr(usage, "candidates_token_count", None) or len(text) // 4
+        planner.record(kwargs.get("question_ratio") or "MCQ", model_name, len(questions),
+                       time.monotonic() - timing["started"], output_tokens)
+        return questions
     except Exception as e:
         print(f"Batch failed: {e}")
         return [] # Trả về rỗng nếu lỗi để không chết cả app
@@ -37,16 +51,9 @@ async def render_test(
     num_questions: int = 15,
     **kwargs # Nhận tất cả các tham số còn lại (current_level, topics...)
 ):
-    BATCH_SIZE = 5 # Mỗi lần chỉ tạo 5 câu để nhanh hơn
-    
-    # Tính toán số lượng batches cần chạy
-    # Ví dụ: 15 câu => [5, 5, 5], 12 câu => [5, 5, 2]
-    batches = []
-    remaining = num_questions
-    while remaining > 0:
-        take = min(remaining, BATCH_SIZE)
-        batches.append(take)
-        remaining -= take
+    # Kích thước batch do planner chọn theo số liệu quan sát (số token / độ trễ mỗi câu)
+    # Ví dụ: chưa có số liệu => 15 câu => [5, 5, 5], 12 câu => [4, 4, 4]
+    batches = planner.plan(num_questions, kwargs.get("question_ratio") or "MCQ", model_name)
 
     # Tạo các task chạy song song
     tasks = [generate_batch(batch_size=b, num_questions=b, **kwargs) for b in batches]
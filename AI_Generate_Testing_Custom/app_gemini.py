@@ -1,16 +1,33 @@
 # app_gemini.py
-import os, asyncio, re, uuid
+import os, asyncio, re, uuid, json, random, time
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 from datetime import datetime
 import motor.motor_asyncio
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from google import genai  # google-genai SDK
+from app import gemini_scheduler
+from app.batch_planner import planner
+from app.inventory import QuestionInventory
+from app.question_loader import QuestionLoader
+from app.dedup import NearDuplicateIndex, question_text, unique_questions
+from app import dedup
 
 # --- Config ---
 API_KEY = os.getenv("GEMINI_API_KEY")
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = "custom_test_db"
+MODEL_NAME = os.getenv("MODEL_NAME", "gemini-2.5-flash")
+# Số vòng sinh bù khi câu mới bị loại vì gần trùng, và số câu gần nhất của ngân hàng giữ trong index chống trùng
+MAX_TOPUP_ROUNDS = int(os.getenv("MAX_TOPUP_ROUNDS", "2"))
+DEDUP_BANK_SIZE = int(os.getenv("DEDUP_BANK_SIZE", "50000"))
+# Số câu mới nhất nạp vào index lúc khởi động (câu lưu sau đó được thêm dần tới DEDUP_BANK_SIZE)
+DEDUP_STARTUP_LOAD = int(os.getenv("DEDUP_STARTUP_LOAD", "10000"))
+DEDUP_LOAD_BATCH = 1000
 
 if not API_KEY:
     raise RuntimeError("Set GEMINI_API_KEY env var first")
@@ -20,7 +37,17 @@ client_genai = genai.Client(vertexai=False, api_key=API_KEY)  # vertexai=True fo
 mongo = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
 db = mongo[DB_NAME]
 
-app = FastAPI(title="Custom Test + Gemini (MCQ & Gap-fill)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    bank_loader = asyncio.create_task(load_bank_index())
+    # Bổ sung kho câu hỏi ngầm trong suốt vòng đời app
+    inventory.start()
+    yield
+    bank_loader.cancel()
+    await inventory.stop()
+
+app = FastAPI(title="Custom Test + Gemini (MCQ & Gap-fill)", lifespan=lifespan)
 
 # --- Models ---
 class PreferredTopics(BaseModel):
@@ -65,17 +92,231 @@ def normalize_answer(s:str):
     return s
 
 # --- Gemini helper: generate questions from prompt ---
-async def gemini_generate_questions(prompt:str, examples:int=5, model:str="gemini-2.5-flash"):
+async def gemini_generate_questions(prompt:str, examples:int=5, model:str="gemini-2.5-flash", timing:Optional[dict]=None):
     """
     Call Gemini to generate structured JSON list of questions (MCQ / Gap-fill).
     We instruct Gemini to return strict JSON with fields: id, type, level, tags, skills, text, options (for mcq), answers.
     """
-    # Use synchronous call style via SDK — wrapper for async usage
-    resp = client_genai.models.generate_content(model=model, contents=prompt)
-    # resp.text() typically returns generated text
-    text = resp.text() if hasattr(resp, "text") else str(resp)
+    # Đi qua scheduler chung: giới hạn đồng thời, RPM/TPM, retry 429/503
+    resp = await gemini_scheduler.run(
+        lambda: client_genai.aio.models.generate_content(model=model, contents=prompt),
+        est_tokens=gemini_scheduler.estimate_tokens(prompt, 250 * examples),
+        timing=timing,
+    )
+    text = resp.text if hasattr(resp, "text") else str(resp)
     return text
 
+def build_generation_prompt(count:int, levels:List[str], tags:Optional[List[str]]=None, qtype:Optional[str]=None):
+    type_rule = f'"{qtype}"' if qtype else '"mcq" or "gap"'
+    tag_rule = f"\n- tags must include: {tags}" if tags else ""
+    return f"""
+You are a strict JSON generator for TOEIC/IELTS style practice. Return a JSON array of exactly {count} questions.
+Each question must be an object with:
+- type: {type_rule}
+- level: one of {levels}
+- tags: array of short tags like "present_perfect", "conditionals_type2", "business_vocab"{tag_rule}
+- skills: ["grammar"] or ["vocabulary"]
+- text: the question text in English (for gap, use ____ to mark blank)
+- options: array of 4 options in English (for mcq)
+- answers: array of acceptable answers
+- explanation: Detailed explanation in **VIETNAMESE** (Tiếng Việt).
+
+Produce valid JSON ONLY. No commentary.
+"""
+
+def parse_generated(text:str):
+    """Parse output của Gemini thành list câu hỏi (chấp nhận rào ```json và dạng {"data": [...]})."""
+    text = re.sub(r"^```(?:json)?|```$", "", (text or "").strip(), flags=re.MULTILINE).strip()
+    arr = json.loads(text)
+    if isinstance(arr, dict):
+        arr = arr.get("data", [])
+    return [q for q in arr if isinstance(q, dict) and q.get("text")]
+
+async def save_questions(questions:List[dict]):
+    """
+    Save generated questions into DB for reuse: một bulk_write unordered (1 round-trip cho cả lô,
+    câu lỗi không chặn các câu còn lại). Trả về danh sách câu lỗi [{"id", "error"}].
+    """
+    if not questions:
+        return []
+    ops = [UpdateOne({"id": q["id"]}, {"$set": q}, upsert=True) for q in questions]
+    try:
+        await db.questions.bulk_write(ops, ordered=False)
+        return []
+    except BulkWriteError as e:
+        failed = [{"id": questions[err["index"]]["id"], "error": err.get("errmsg", "")}
+                  for err in e.details.get("writeErrors", [])]
+        print(f"⚠️ Lưu câu hỏi: {len(failed)}/{len(questions)} câu lỗi: {failed}")
+        return failed
+
+async def generate_batch(count:int, levels:List[str], tags:Optional[List[str]]=None, qtype:Optional[str]=None):
+    """Một lời gọi Gemini cho `count` câu; lỗi hoặc output hỏng thì trả về [] (không làm hỏng cả đề)."""
+    prompt = build_generation_prompt(count, levels, tags, qtype)
+    timing = {}  # scheduler ghi timing["started"] khi lấy được slot (không tính chờ hàng đợi / backoff)
+    try:
+        text = await gemini_generate_questions(prompt, examples=count, model=MODEL_NAME, timing=timing)
+        questions = parse_generated(text)[:count]
+    except Exception as e:
+        print("Gemini batch error:", e)
+        return []
+    planner.record(qtype or "mixed", MODEL_NAME, len(questions), time.monotonic() - timing["started"], len(text) // 4)
+
+    for q in questions:
+        # id do server cấp: id của Gemini ("q1", ...) trùng giữa các lần sinh sẽ ghi đè câu cũ (cache coi câu là bất biến)
+        q["id"] = uuid.uuid4().hex[:12]
+        if qtype:
+            q["type"] = qtype
+        if q.get("level") not in levels:
+            q["level"] = levels[0]
+        if tags and not set(tags) & set(q.get("tags") or []):
+            q["tags"] = (q.get("tags") or []) + [tags[0]]
+    return questions
+
+async def generate_questions(count:int, levels:List[str], tags:Optional[List[str]]=None, qtype:Optional[str]=None):
+    """
+    Sinh `count` câu: planner chia batch, các batch chạy song song (chung client_genai + scheduler),
+    rồi lưu cả lô bằng một bulk_write. Trả về các câu đã lưu thành công.
+    """
+    questions = []
+    rounds = 0
+    while len(questions) < count and rounds <= MAX_TOPUP_ROUNDS:
+        batches = planner.plan(count - len(questions), qtype or "mixed", MODEL_NAME)
+        results = await asyncio.gather(*(generate_batch(b, levels, tags, qtype) for b in batches))
+        # Câu gần trùng với ngân hàng (hoặc với câu vừa sinh) bị loại trước khi lưu; vòng sau sinh bù đúng phần thiếu
+        questions += [q for batch in results for q in batch if bank_index.add_if_new(q["id"], question_text(q))]
+        rounds += 1
+    questions, extra = questions[:count], questions[count:]
+    # Đề chỉ lưu question_ids => câu nào lưu lỗi thì không được đưa vào đề
+    failed_ids = {f["id"] for f in await save_questions(questions)}
+    for qid in failed_ids | {q["id"] for q in extra}:
+        bank_index.remove(qid)
+    return [q for q in questions if q["id"] not in failed_ids]
+
+async def generate_for_bucket(level:str, tag:str, qtype:str, count:int):
+    """Sinh `count` câu cho một bucket của kho và lưu vào DB; trả về số câu đã lưu."""
+    return len(await generate_questions(count, [level], [tag] if tag else None, qtype))
+
+inventory = QuestionInventory(db, generate_for_bucket)
+
+# Index chống trùng của ngân hàng câu hỏi (nạp ngầm lúc khởi động, cập nhật khi lưu câu mới)
+bank_index = NearDuplicateIndex(max_items=DEDUP_BANK_SIZE)
+
+async def load_bank_index():
+    """Nạp câu gần nhất theo lô; chữ ký MinHash tính ở process riêng để không chặn event loop."""
+    limit = min(DEDUP_BANK_SIZE, DEDUP_STARTUP_LOAD)
+    cursor = db.questions.find({}, {"_id": 0, "id": 1, "text": 1, "options": 1}).sort("_id", -1).limit(limit)
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=1)
+    loaded = 0
+    try:
+        while True:
+            batch = await cursor.to_list(length=DEDUP_LOAD_BATCH)
+            if not batch:
+                break
+            batch = [q for q in batch if q.get("id")]
+            sigs = await loop.run_in_executor(pool, dedup.signatures, [question_text(q) for q in batch])
+            for q, sig in zip(batch, sigs):
+                bank_index.add(q["id"], "", sig)
+            loaded += len(batch)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    print(f"✅ Đã nạp {loaded} câu vào index chống trùng")
+
+# --- Mongo: indexes + server-side sampling ---
+# Chỉ lấy các field cần cho đề / chấm điểm (không kéo _id và field phụ qua mạng)
+QUESTION_PROJECTION = {"_id": 0, "id": 1, "type": 1, "level": 1, "tags": 1, "skills": 1, "text": 1,
+                       "options": 1, "answers": 1, "explanation": 1, "time_estimate": 1}
+
+# Tên riêng cho index thường dự phòng: không chiếm tên mặc định id_1 của index unique
+ID_FALLBACK_INDEX = "id_nonunique"
+
+async def count_duplicate_ids(collection) -> int:
+    """Số giá trị id (kể cả thiếu id) đang nằm ở nhiều hơn một document."""
+    pipeline = [{"$group": {"_id": "$id", "n": {"$sum": 1}}}, {"$match": {"n": {"$gt": 1}}}, {"$count": "duplicates"}]
+    rows = await collection.aggregate(pipeline, allowDiskUse=True).to_list(length=1)
+    return rows[0]["duplicates"] if rows else 0
+
+async def ensure_unique_id(collection):
+    """
+    Index unique trên `id`. Dữ liệu cũ có id trùng / thiếu id thì Mongo từ chối (DuplicateKeyError) =>
+    ghi log số id trùng, dùng index thường ID_FALLBACK_INDEX để truy vấn vẫn nhanh, service vẫn khởi động.
+    Dọn dữ liệu rồi restart: index thường (kể cả id_1 không unique của bản cũ) được bỏ và unique được tạo lại.
+    """
+    on_id = {name: info for name, info in (await collection.index_information()).items()
+             if info.get("key") == [("id", 1)]}
+    if any(info.get("unique") for info in on_id.values()):
+        return
+    # Index thường trên id chặn việc tạo unique cùng key (IndexOptionsConflict) => chỉ giữ khi vẫn còn id trùng
+    plain = list(on_id)
+    duplicates = await count_duplicate_ids(collection) if plain else 0
+    if not duplicates:
+        for name in plain:
+            try:
+                await collection.drop_index(name)
+            except OperationFailure:
+                pass  # worker khác vừa bỏ index này
+        plain = []
+        try:
+            await collection.create_index("id", unique=True)
+            return
+        except OperationFailure as e:
+            print(f"⚠️ Không tạo được unique index {collection.name}.id ({e.code}): {e}")
+            duplicates = await count_duplicate_ids(collection)
+    print(f"⚠️ {collection.name}: {duplicates} giá trị id bị trùng / thiếu => dùng index thường {ID_FALLBACK_INDEX}; "
+          f"dọn dữ liệu rồi restart để bật unique.")
+    if not plain:
+        try:
+            await collection.create_index("id", name=ID_FALLBACK_INDEX)
+        except OperationFailure as e:
+            print(f"⚠️ Không tạo được index {collection.name}.id: {e}")
+
+async def ensure_indexes():
+    """Tạo index lúc khởi động (idempotent: index đã có thì Mongo bỏ qua)."""
+    await asyncio.gather(
+        db.questions.create_index([("level", 1), ("type", 1), ("tags", 1)]),
+        ensure_unique_id(db.questions),
+        ensure_unique_id(db.tests),
+        db.attempts.create_index([("userId", 1), ("submittedAt", -1)]),
+    )
+
+async def sample_questions(levels:List[str], tags:List[str], qtype:str, k:int):
+    """Chọn ngẫu nhiên k câu một loại ngay trên Mongo ($match theo index + $sample), không tải cả tập ứng viên."""
+    if k <= 0:
+        return []
+    match = {"level": {"$in": levels}, "type": qtype}
+    if tags:
+        match["tags"] = {"$in": tags}
+    pipeline = [{"$match": match}, {"$sample": {"size": k}}, {"$project": QUESTION_PROJECTION}]
+    return await db.questions.aggregate(pipeline).to_list(length=k)
+
+# Câu hỏi nóng giữ trong bộ nhớ; đề chỉ lưu question_ids
+question_loader = QuestionLoader(db.questions, projection=QUESTION_PROJECTION)
+
+async def find_test_questions(test_id:str):
+    """Nạp câu hỏi của đề theo question_ids (đề cũ còn lưu inline "questions" thì dùng luôn)."""
+    test = await db.tests.find_one({"id": test_id}, {"_id": 0, "question_ids": 1, "questions": 1})
+    if not test:
+        raise HTTPException(status_code=404, detail="Test not found")
+    if test.get("questions"):
+        return test["questions"]
+    return await question_loader.load(test.get("question_ids", []))
+
+@app.get("/metrics/gemini-scheduler")
+async def gemini_scheduler_metrics():
+    return gemini_scheduler.get_stats()
+
+@app.get("/metrics/inventory")
+async def inventory_metrics():
+    return inventory.get_stats()
+
+@app.get("/metrics/dedup")
+async def dedup_metrics():
+    return {**dedup.get_stats(), "bank_items": len(bank_index)}
+
+@app.get("/metrics/question-cache")
+async def question_cache_metrics():
+    return question_loader.get_stats()
+
 # --- Route: admin add question (optional) ---
 @app.post("/questions/add")
 async def add_question(q: dict):
@@ -83,81 +324,56 @@ async def add_question(q: dict):
     q_id = q.get("id") or str(uuid.uuid4())
     q["id"] = q_id
     await db.questions.update_one({"id": q_id}, {"$set": q}, upsert=True)
+    question_loader.invalidate(q_id)
+    bank_index.add(q_id, question_text(q))
     return {"status":"ok", "id": q_id}
 
 # --- Route: create custom test ---
 @app.post("/tests/custom")
 async def create_custom_test(req: CreateTestRequest):
+    # Đánh dấu service đang bận để kho không sinh ngầm tranh quota với request
+    inventory.request_started()
+    try:
+        return await build_custom_test(req)
+    finally:
+        inventory.request_finished()
+
+async def build_custom_test(req: CreateTestRequest):
     profile = req.profile
     prefs = req.testPreferences
 
     # 1) compute level range
     lr = map_level_range(profile.currentLevel, prefs.difficultyPreference)
 
-    # 2) try to fetch questions from DB matching tags/levels
-    pref_tags = (profile.preferredTopics.grammar or []) + (profile.preferredTopics.vocabulary or [])
-    query = {"level": {"$in": lr}}
-    if pref_tags:
-        query["tags"] = {"$in": pref_tags}
-
-    # fetch candidates
-    candidates = await db.questions.find(query).to_list(length=500)
-    # categorize
-    mcq_cands = [c for c in candidates if c.get("type")=="mcq"]
-    gap_cands = [c for c in candidates if c.get("type")=="gap"]
-
-    # 3) decide counts
+    # 2) decide counts
     num = prefs.numQuestions
     mcq_count = round(num * (prefs.questionRatio.get("mcq",70)/100))
     gap_count = num - mcq_count
 
-    selected = []
-    import random
-    def sample_or_none(lst, k):
-        if not lst:
-            return []
-        if len(lst) >= k:
-            return random.sample(lst, k)
-        else:
-            return lst.copy()
-
-    selected += sample_or_none(mcq_cands, mcq_count)
-    selected += sample_or_none(gap_cands, gap_count)
+    # 3) sample questions from DB matching tags/levels (server-side, one aggregation per type)
+    pref_tags = (profile.preferredTopics.grammar or []) + (profile.preferredTopics.vocabulary or [])
+    mcq_sel, gap_sel = await asyncio.gather(
+        sample_questions(lr, pref_tags, "mcq", mcq_count),
+        sample_questions(lr, pref_tags, "gap", gap_count),
+    )
+    # Ngân hàng cũ có thể còn câu gần trùng: không để chúng vào cùng một đề (thiếu thì bước 4 sinh bù)
+    seen = NearDuplicateIndex()
+    mcq_sel, gap_sel = unique_questions(mcq_sel, seen), unique_questions(gap_sel, seen)
+    selected = mcq_sel + gap_sel
 
     # 4) If not enough questions in DB, call Gemini to generate missing ones
     missing = num - len(selected)
+    # Báo cho kho các bucket request này cần; thiếu câu thì kho bổ sung ngay khi rảnh
+    types = [t for t, k in (("mcq", mcq_count), ("gap", gap_count)) if k > 0]
+    inventory.note_demand([(lvl, tag, t) for lvl in lr for tag in (pref_tags or [""]) for t in types],
+                          short=missing > 0)
     if missing > 0:
-        # Build robust prompt instructing Gemini to output strict JSON array
-        prompt = f"""
-You are a strict JSON generator for TOEIC/IELTS style practice. Return a JSON array of exactly {missing} questions.
-Each question must be an object with:
-- id: short unique id
-- type: "mcq" or "gap"
-- level: one of {lr}
-- tags: array of short tags like "present_perfect", "conditionals_type2", "business_vocab"
-- skills: ["grammar"] or ["vocabulary"]
-- text: the question text in English (for gap, use ____ to mark blank)
-- options: array of 4 options in English (for mcq)
-- answers: array of acceptable answers
-- explanation: Detailed explanation in **VIETNAMESE** (Tiếng Việt).
-
-Produce valid JSON ONLY. No commentary.
-"""
-        gen_text = await asyncio.to_thread(gemini_generate_questions, prompt)
-        # try parse JSON from gen_text
-        import json
-        try:
-            arr = json.loads(gen_text)
-            # minimal validation
-            for q in arr:
-                q["id"] = q.get("id") or str(uuid.uuid4())[:8]
-                selected.append(q)
-                # save generated question into DB for reuse
-                await db.questions.update_one({"id": q["id"]}, {"$set": q}, upsert=True)
-        except Exception as e:
-            # fallback: if parsing fails, return error but continue with what we have
-            print("Gemini parse error:", e)
-            # As graceful fallback, continue with selected
+        # Sinh phần thiếu theo từng loại để giữ đúng tỉ lệ mcq/gap; batch lỗi chỉ làm đề ngắn đi, không hỏng cả đề
+        mcq_gen, gap_gen = await asyncio.gather(
+            generate_questions(mcq_count - len(mcq_sel), lr, pref_tags, "mcq"),
+            generate_questions(gap_count - len(gap_sel), lr, pref_tags, "gap"),
+        )
+        selected += mcq_gen + gap_gen
 
     # shuffle and cut to requested num
     random.shuffle(selected)
@@ -170,11 +386,11 @@ Produce valid JSON ONLY. No commentary.
         "creatorId": req.userId,
         "profileSnapshot": profile.dict(),
         "settings": prefs.dict(),
-        "question_ids": [q["id"] for q in selected],
-        "questions": selected,  # store inline for demo; in prod store refs only
+        "question_ids": [q["id"] for q in selected],  # chỉ lưu tham chiếu, câu hỏi nạp qua question_loader
         "createdAt": now
     }
     await db.tests.insert_one(test_doc)
+    question_loader.prime(selected)
 
     # return summary for frontend
     dist = {"mcq": sum(1 for q in selected if q.get("type")=="mcq"), "gap": sum(1 for q in selected if q.get("type")=="gap")}
@@ -184,12 +400,10 @@ Produce valid JSON ONLY. No commentary.
 # --- Route: get questions (no answers) ---
 @app.get("/tests/{test_id}/questions")
 async def get_questions(test_id: str):
-    test = await db.tests.find_one({"id": test_id})
-    if not test:
-        raise HTTPException(status_code=404, detail="Test not found")
+    questions = await find_test_questions(test_id)
     # strip answers before returning
     qs = []
-    for q in test["questions"]:
+    for q in questions:
         q_no_answer = {k:v for k,v in q.items() if k not in ("answers",)}
         qs.append(q_no_answer)
     return {"testId": test_id, "questions": qs}
@@ -211,11 +425,9 @@ class SubmitAttempt(BaseModel):
 
 @app.post("/attempts")
 async def submit_attempt(payload: SubmitAttempt):
-    test = await db.tests.find_one({"id": payload.testId})
-    if not test:
-        raise HTTPException(status_code=404, detail="Test not found")
-    qmap = {q["id"]: q for q in test["questions"]}
-    correct=0; total=len(test["questions"])
+    questions = await find_test_questions(payload.testId)
+    qmap = {q["id"]: q for q in questions}
+    correct=0; total=len(questions)
     skill_scores = {"grammar": {"score":0,"max":0},"vocabulary":{"score":0,"max":0}}
     # MCQ
     for a in payload.mcqAnswers or []:
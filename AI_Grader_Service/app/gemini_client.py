@@ -3,6 +3,7 @@ import json
 import httpx
 from typing import Dict, Any, Optional
 from dotenv import load_dotenv
+from . import gemini_scheduler
 
 load_dotenv(override=True)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
@@ -11,6 +12,65 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 # Đã sửa lại URL thành 1.5-flash để tránh lỗi 404
 GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
 
+# --- Connection pool dùng chung cho toàn app (tạo/đóng trong lifespan của FastAPI) ---
+GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "true").lower() in ("1", "true", "yes")
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "10"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "60"))
+
+# Ước lượng output token của một bản phân tích (để trừ ngân sách TPM)
+ANALYSIS_OUTPUT_TOKENS = 3000
+
+_http_client: Optional[httpx.AsyncClient] = None
+_pool_stats = {"requests": 0, "new_connections": 0}
+
+
+async def _trace(event_name: str, info: Dict[str, Any]):
+    """Hook của httpcore: mỗi lần mở TCP mới nghĩa là không tái sử dụng được kết nối cũ."""
+    if event_name == "connection.connect_tcp.complete":
+        _pool_stats["new_connections"] += 1
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """Tạo AsyncClient dùng chung (keep-alive + HTTP/2). Gọi khi app khởi động."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=GEMINI_HTTP2,
+            timeout=httpx.Timeout(connect=5.0, read=45.0, write=10.0, pool=10.0),
+            limits=httpx.Limits(
+                max_connections=GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=GEMINI_MAX_KEEPALIVE,
+                keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Đóng pool khi app tắt."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Số liệu tái sử dụng kết nối tới Gemini."""
+    requests = _pool_stats["requests"]
+    new_conns = _pool_stats["new_connections"]
+    reused = max(0, requests - new_conns)
+    return {
+        "http2": GEMINI_HTTP2,
+        "max_connections": GEMINI_MAX_CONNECTIONS,
+        "max_keepalive_connections": GEMINI_MAX_KEEPALIVE,
+        "requests": requests,
+        "new_connections": new_conns,
+        "reused_connections": reused,
+        "reuse_ratio": round(reused / requests, 3) if requests else 0.0,
+    }
+
+
 def _build_prompt(payload: Dict[str, Any], local_results: Dict[str, Any]) -> str:
     """
     Xây dựng prompt dựa trên Profile, Kết quả chấm và Trend đã tính toán.
@@ -155,19 +215,25 @@ async def call_gemini_analysis(payload: Dict[str, Any], local_results: Dict[str,
         }
     }
 
-    # 3. Timeout settings
-    timeout = httpx.Timeout(connect=5.0, read=45.0, write=10.0, pool=10.0)
+    # 3. Dùng client dùng chung (khởi tạo lười nếu chạy ngoài lifespan)
+    client = _http_client or await init_http_client()
+
+    async def _post() -> Dict[str, Any]:
+        _pool_stats["requests"] += 1
+        resp = await client.post(url, headers=headers, json=body, extensions={"trace": _trace})
+
+        if resp.status_code != 200:
+            print(f"❌ GEMINI API ERROR: {resp.status_code} - {resp.text}")
+            resp.raise_for_status()
+
+        return resp.json()
 
     try:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            resp = await client.post(url, headers=headers, json=body)
-            
-            if resp.status_code != 200:
-                print(f"❌ GEMINI API ERROR: {resp.status_code} - {resp.text}")
-                resp.raise_for_status()
-                
-            data = resp.json()
-            
+        # Đi qua scheduler chung: giới hạn đồng thời, RPM/TPM, retry 429/503
+        data = await gemini_scheduler.run(
+            _post, est_tokens=gemini_scheduler.estimate_tokens(prompt_text, ANALYSIS_OUTPUT_TOKENS)
+        )
+
     except httpx.RequestError as re:
         raise RuntimeError(f"Network error calling Gemini: {str(re)}")
     except httpx.HTTPStatusError as he:
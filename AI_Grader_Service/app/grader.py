@@ -1,60 +1,95 @@
-from collections import defaultdict
-from typing import List, Dict
-from .schemas import QuestionKey, PerQuestionResult, SkillSummary
+import heapq
+from typing import List, Dict, Optional
+from .schemas import QuestionKey, SkillSummary
 
-def grade_locally(answer_key: List[QuestionKey], student_answers: Dict[int, str]):
+
+class NormalizedKey:
+    """
+    Đáp án đã chuẩn hóa sẵn (strip/upper, id dạng chuỗi, chỉ số kỹ năng) để chấm nhiều lần
+    không phải xử lý lại; tạo một lần cho mỗi đề rồi dùng chung cho mọi bài nộp.
+    """
+    __slots__ = ("ids", "str_ids", "questions", "expected", "skills", "topics", "skill_idx", "skill_names")
+
+    def __init__(self, answer_key: List[QuestionKey]):
+        self.ids = [q.id for q in answer_key]
+        self.str_ids = [str(q.id) for q in answer_key]
+        self.questions = [q.question for q in answer_key]
+        self.expected = [q.answer.strip().upper() if q.answer else "" for q in answer_key]
+        self.skills = [q.skill for q in answer_key]
+        self.topics = [q.topic for q in answer_key]
+        # Kỹ năng theo thứ tự xuất hiện (giữ đúng thứ tự skill_summary như trước)
+        self.skill_names = list(dict.fromkeys(s or "Unknown" for s in self.skills))
+        pos = {name: i for i, name in enumerate(self.skill_names)}
+        self.skill_idx = [pos[s or "Unknown"] for s in self.skills]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def grade_normalized(key: NormalizedKey, student_answers: Dict[str, str], explain: bool = True):
+    """
+    Đường nhanh của grade_locally: một vòng lặp, mỗi câu trả lời chỉ chuẩn hóa một lần,
+    kết quả từng câu là dict thuần theo khuôn PerQuestionResult (rẻ hơn ~10 lần so với tạo model;
+    GradeResponse validate một lần ở biên response), câu giải thích chỉ sinh khi explain=True.
+    """
+    n_skills = len(key.skill_names)
+    skill_correct = [0] * n_skills
+    skill_total = [0] * n_skills
+    wrong_topics: List[Dict[str, int]] = [{} for _ in range(n_skills)]
+    per_q: List[dict] = []
+    get = student_answers.get
     total_correct = 0
-    per_q: List[PerQuestionResult] = []
-    skill_stats = defaultdict(lambda: {"correct": 0, "total": 0, "topics": defaultdict(int)})
-
-    for q in answer_key:
-        qid = q.id
-        expected = q.answer.strip().upper() if q.answer else ""
-        user_ans = student_answers.get(qid) or student_answers.get(str(qid))
-        correct = (user_ans.strip().upper() == expected) if user_ans else False
+
+    for i, sid in enumerate(key.str_ids):
+        user_ans = get(sid)
+        if user_ans is None:
+            user_ans = get(key.ids[i])
+        user_norm = user_ans.strip().upper() if user_ans else None
+        expected = key.expected[i]
+        correct = user_norm == expected if user_ans else False
+
+        k = key.skill_idx[i]
+        skill_total[k] += 1
         if correct:
             total_correct += 1
+            skill_correct[k] += 1
+        else:
+            topic = key.topics[i]
+            if topic:
+                counts = wrong_topics[k]
+                counts[topic] = counts.get(topic, 0) + 1
 
-        explain_text = "Correct." if correct else f"Expected \"{expected}\" but got \"{(user_ans or 'no answer')}\"."
-
-        per_q.append(PerQuestionResult(
-            id=qid,
-            question=getattr(q, "question", None),
-            correct=correct,
-            expected_answer=expected,
-            user_answer=(user_ans.strip().upper() if user_ans else None),
-            skill=q.skill,
-            topic=q.topic,
-            explain=explain_text
-        ))
-
-        # skill stats
-        skill_key = q.skill or "Unknown"
-        skill_stats[skill_key]["total"] += 1
-        if correct:
-            skill_stats[skill_key]["correct"] += 1
-        if q.topic and not correct:
-            skill_stats[skill_key]["topics"][q.topic] += 1
+        if explain:
+            explain_text = "Correct." if correct else f"Expected \"{expected}\" but got \"{(user_ans or 'no answer')}\"."
+        else:
+            explain_text = None
+        per_q.append({
+            "id": key.ids[i],
+            "question": key.questions[i],
+            "correct": correct,
+            "expected_answer": expected,
+            "user_answer": user_norm,
+            "skill": key.skills[i],
+            "topic": key.topics[i],
+            "explain": explain_text,
+        })
 
-    # skill summary
+    # skill summary + weak topics (mỗi kỹ năng 2 chủ đề sai nhiều nhất, tổng tối đa 3)
     skill_summary = []
-    weak_topics_grab = []
-    for skill, st in skill_stats.items():
-        total = st["total"]
-        correct = st["correct"]
-        accuracy = (correct / total * 100) if total > 0 else 0.0
-        skill_summary.append(SkillSummary(skill=skill, total=total, correct=correct, accuracy=round(accuracy, 2)))
-        sorted_topics = sorted(st["topics"].items(), key=lambda x: x[1], reverse=True)
-        for tname, _ in sorted_topics[:2]:
-            weak_topics_grab.append(f"{skill} - {tname}")
-
-    seen = set()
-    weak_topics = []
-    for t in weak_topics_grab:
-        if t not in seen:
-            weak_topics.append(t)
-            seen.add(t)
-        if len(weak_topics) >= 3:
-            break
-
-    return total_correct, len(answer_key), per_q, skill_summary, weak_topics
+    weak_topics: List[str] = []
+    for k, skill in enumerate(key.skill_names):
+        total = skill_total[k]
+        accuracy = (skill_correct[k] / total * 100) if total > 0 else 0.0
+        skill_summary.append(SkillSummary(skill=skill, total=total, correct=skill_correct[k], accuracy=round(accuracy, 2)))
+        for tname, _ in heapq.nlargest(2, wrong_topics[k].items(), key=lambda x: x[1]):
+            name = f"{skill} - {tname}"
+            if len(weak_topics) < 3 and name not in weak_topics:
+                weak_topics.append(name)
+
+    return total_correct, len(key), per_q, skill_summary, weak_topics
+
+
+def grade_locally(answer_key: List[QuestionKey], student_answers: Dict[int, str],
+                  explain: bool = True, key: Optional[NormalizedKey] = None):
+    """Chấm một bài; truyền `key` (NormalizedKey đã tạo sẵn cho đề) để bỏ qua bước chuẩn hóa đáp án."""
+    return grade_normalized(key or NormalizedKey(answer_key), student_answers, explain)
@@ -1,77 +1,110 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
 from fastapi import FastAPI, HTTPException
 from fastapi.encoders import jsonable_encoder
 from typing import Optional, List, Any
-import statistics # Thư viện toán học tiêu chuẩn
 
 # Import các module nội bộ
-from .schemas import GradeRequest, GradeResponse, PersonalizedPlan
+from .schemas import GradeRequest, GradeResponse, PersonalizedPlan, LearningProfile, TrendState
+from .schemas import RegisterKeyRequest, RegisterKeyResponse
 from .grader import grade_locally
-from .gemini_client import call_gemini_analysis
+from .trend import update_trend, trend_from_history, calculate_trend_metrics
+from .answer_keys import registry as answer_keys
+from .profile_store import get_store, close_store, attempt_summary
+from .gemini_client import call_gemini_analysis, init_http_client, close_http_client, get_pool_stats
+from . import gemini_scheduler
 
 # [THAY ĐỔI 1] Bỏ dòng import này vì không còn dùng mapper thủ công nữa
 # from .material_mapper import get_materials_from_database 
 
-app = FastAPI(title="AI Grader Service")
-
-def calculate_trend_metrics(history: List[Any], current_score_percent: float):
-    """
-    Hàm Python thuần để tính toán xu hướng học tập.
-    """
-    scores = []
-    
-    for h in history:
-        val = None
-        if hasattr(h, 'score_percentage'): 
-            val = h.score_percentage
-        elif isinstance(h, dict): 
-            val = h.get('score_percentage')
-            
-        if val is not None:
-            scores.append(float(val))
-            
-    scores.append(current_score_percent)
-
-    n = len(scores)
-    
-    if n < 2:
-        return {
-            "past_tests": 0,
-            "accuracy_growth_rate": 0.0,
-            "consistency_index": 1.0, 
-            "scores_trajectory": scores
-        }
-
-    growth_rate = (scores[-1] - scores[0]) / n
-
-    try:
-        stdev = statistics.stdev(scores)
-        consistency = max(0.0, 1.0 - (stdev / 25.0))
-    except:
-        consistency = 1.0
-
-    return {
-        "past_tests": n - 1,
-        "accuracy_growth_rate": round(growth_rate, 2),
-        "consistency_index": round(consistency, 2),
-        "scores_trajectory": scores 
-    }
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Mở connection pool tới Gemini một lần cho cả vòng đời app
+    await init_http_client()
+    yield
+    await close_http_client()
+    close_store()
+
+app = FastAPI(title="AI Grader Service", lifespan=lifespan)
+
+def resolve_answer_key(test_id: Optional[str], answer_key: Optional[List[Any]]):
+    """Đáp án gửi kèm request, hoặc đáp án đã đăng ký theo test_id; 404 để backend gửi lại answer_key."""
+    entry = answer_keys.resolve(test_id, answer_key)
+    if entry is None:
+        if not test_id:
+            raise HTTPException(status_code=400, detail="Either answer_key or test_id is required")
+        raise HTTPException(status_code=404, detail=f"Answer key for test '{test_id}' is not registered")
+    return entry
+
+@app.post("/grade/keys", response_model=RegisterKeyResponse)
+async def register_answer_key(req: RegisterKeyRequest):
+    """Đăng ký đáp án của một đề một lần; các bài nộp sau chỉ cần gửi test_id + student_answers."""
+    entry = answer_keys.register(req.test_id, req.answer_key)
+    return RegisterKeyResponse(
+        test_id=req.test_id,
+        total_questions=len(entry),
+        skills=entry.normalized.skill_names,
+    )
+
+@app.delete("/grade/keys/{test_id}")
+async def remove_answer_key(test_id: str):
+    if not answer_keys.remove(test_id):
+        raise HTTPException(status_code=404, detail=f"Answer key for test '{test_id}' is not registered")
+    return {"test_id": test_id, "removed": True}
+
+@app.post("/grade/profiles")
+async def save_profile(profile: LearningProfile):
+    """Lưu / cập nhật hồ sơ học viên vào kho của grader; các lần chấm sau chỉ cần gửi student_id."""
+    return {"student_id": profile.student_id, **await asyncio.to_thread(get_store().save_profile, profile)}
+
+@app.get("/grade/profiles/{student_id}")
+async def get_profile(student_id: str):
+    stored = await asyncio.to_thread(get_store().get, student_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Profile for student '{student_id}' not found")
+    return {"student_id": student_id, **stored}
 
 @app.post("/grade", response_model=GradeResponse)
 async def grade_endpoint(req: GradeRequest):
+    key = resolve_answer_key(req.test_id, req.answer_key)
+    student_id = req.profile.student_id if req.profile else req.student_id
     try:
+        # ==================================================================
+        # BƯỚC 0: HỒ SƠ HỌC VIÊN (kho của grader; profile gửi kèm thì lưu / cập nhật vào kho)
+        # ==================================================================
+        store = get_store() if student_id else None
+        stored = None
+        if store and req.profile:
+            stored = await asyncio.to_thread(store.save_profile, req.profile)
+        elif store:
+            stored = await asyncio.to_thread(store.get, student_id)
+        stored_profile = stored["profile"] if stored else {}
+
         # ==================================================================
         # BƯỚC 1: CHẤM ĐIỂM LOCAL 
         # ==================================================================
         total_correct, total_qs, per_q, skill_summary, weak_topics = grade_locally(
-            req.answer_key, req.student_answers
+            req.answer_key, req.student_answers, explain=req.include_explanations is not False,
+            key=key.normalized,
         )
 
         current_score_percent = (total_correct / total_qs * 100) if total_qs > 0 else 0.0
 
+        # Trạng thái xu hướng: lấy từ request / kho hồ sơ (O(1)), hoặc dựng một lần từ test_history kiểu cũ
+        if req.trend_state:
+            prior_trend = req.trend_state
+        elif stored and stored["trend_state"]:
+            prior_trend = TrendState(**stored["trend_state"])
+        else:
+            prior_trend = trend_from_history(req.profile.test_history if req.profile else [])
+        trend_state = update_trend(prior_trend, current_score_percent)
+
         recommendations = []
         personalized_plan = None
         post_test_level = "Determining..."
-        current_level = req.profile.current_level if req.profile else "Unknown"
+        current_level = req.profile.current_level if req.profile else stored_profile.get("current_level", "Unknown")
+        level_at_test = current_level
         final_weak_topics = weak_topics 
 
         # ==================================================================
@@ -80,12 +113,15 @@ async def grade_endpoint(req: GradeRequest):
         if req.use_gemini:
             try:
                 # --- A. Tính toán Trend bằng Python ---
-                raw_history = req.profile.test_history if req.profile else []
-                trend_data = calculate_trend_metrics(raw_history, current_score_percent)
+                trend_data = calculate_trend_metrics(trend_state)
 
                 # --- B. Chuẩn bị dữ liệu Profile ---
-                profile_data = jsonable_encoder(req.profile) if req.profile else {}
-                
+                if stored:
+                    # Lịch sử trong kho đã rút gọn sẵn (không có per_question)
+                    profile_data = {**stored_profile, "test_history": stored["test_history"]}
+                else:
+                    profile_data = jsonable_encoder(req.profile) if req.profile else {}
+
                 if "test_history" in profile_data:
                     for h in profile_data["test_history"]:
                         if "per_question" in h: 
@@ -142,7 +178,30 @@ async def grade_endpoint(req: GradeRequest):
                 post_test_level = "Unknown (AI Error)"
 
         # ==================================================================
-        # BƯỚC 3: TRẢ VỀ KẾT QUẢ
+        # BƯỚC 3: GHI BÀI VỪA CHẤM VÀO HỒ SƠ (bản rút gọn + cập nhật trend_state)
+        # ==================================================================
+        if store:
+            summary = attempt_summary({
+                "test_date": date.today().isoformat(),
+                "test_id": key.test_id,
+                "title": req.test_info.title if req.test_info else None,
+                "level_at_test": level_at_test,
+                "total_score": total_correct,
+                "total_questions": total_qs,
+                "score_percentage": current_score_percent,
+                "weak_topics": final_weak_topics,
+                "skill_accuracy": {s.skill: s.accuracy for s in skill_summary},
+            })
+            try:
+                # Cập nhật trend trong khóa của kho (bài nộp song song không ghi đè nhau) => dùng state kho trả về
+                trend_state = await asyncio.to_thread(
+                    store.append_attempt, student_id, summary, current_score_percent, prior_trend
+                )
+            except Exception as e:
+                print(f"⚠️ SAVE ATTEMPT FAILED ({student_id}): {str(e)}")
+
+        # ==================================================================
+        # BƯỚC 4: TRẢ VỀ KẾT QUẢ
         # ==================================================================
         return GradeResponse(
             total_score=total_correct,
@@ -153,8 +212,25 @@ async def grade_endpoint(req: GradeRequest):
             recommendations=recommendations,
             personalized_plan=personalized_plan,
             current_level=current_level,
-            post_test_level=post_test_level
+            post_test_level=post_test_level,
+            trend_state=trend_state,
         )
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+@app.get("/metrics/gemini-http")
+async def gemini_http_metrics():
+    return get_pool_stats()
+
+@app.get("/metrics/gemini-scheduler")
+async def gemini_scheduler_metrics():
+    return gemini_scheduler.get_stats()
+
+@app.get("/metrics/answer-keys")
+async def answer_key_metrics():
+    return answer_keys.get_stats()
+
+@app.get("/metrics/profiles")
+async def profile_metrics():
+    return get_store().get_stats()
@@ -99,12 +99,28 @@ class LearningProfile(BaseModel):
     study_methods: List[str]
     test_history: List[TestHistoryItem]
 
+class TrendState(BaseModel):
+    """Thống kê xu hướng cộng dồn của một học sinh (cập nhật O(1) mỗi bài; backend lưu lại và gửi kèm lần sau)."""
+    count: int = 0
+    first_score: float = 0.0
+    last_score: float = 0.0
+    mean: float = 0.0
+    m2: float = 0.0  # tổng bình phương độ lệch (Welford) => phương sai = m2 / (count - 1)
+    recent_scores: List[float] = []  # N điểm gần nhất (TREND_WINDOW) để vẽ biểu đồ
+
 class GradeRequest(BaseModel):
     test_info: Optional[TestInfo] = None
-    answer_key: List[QuestionKey]
+    # Đề đã đăng ký (POST /grade/keys) => chỉ cần test_id, không phải gửi lại answer_key
+    test_id: Optional[str] = None
+    answer_key: Optional[List[QuestionKey]] = None
     student_answers: Dict[str, str]
     use_gemini: Optional[bool] = False
-    profile: Optional[LearningProfile]
+    # Học viên đã có hồ sơ trong kho của grader (POST /grade/profiles) => chỉ cần student_id
+    student_id: Optional[str] = None
+    profile: Optional[LearningProfile] = None
+    # Có trend_state (lấy từ response lần trước) => không cần đọc lại toàn bộ test_history để tính xu hướng
+    trend_state: Optional[TrendState] = None
+    include_explanations: Optional[bool] = True  # False => bỏ câu giải thích từng câu (đề dài chấm nhanh hơn)
 
 class GradeResponse(BaseModel):
     total_score: int
@@ -121,4 +137,16 @@ class GradeResponse(BaseModel):
     
     # [THÊM] Hứng thêm dữ liệu từ AI
     proficiency_prediction: Optional[ProficiencyPrediction] = None 
-    monitoring_alerts: Optional[List[str]] = []
\ No newline at end of file
+    monitoring_alerts: Optional[List[str]] = []
+
+    # Trạng thái xu hướng đã gồm bài này: backend lưu lại và gửi kèm ở lần chấm sau
+    trend_state: Optional[TrendState] = None
+
+class RegisterKeyRequest(BaseModel):
+    test_id: str
+    answer_key: List[QuestionKey]
+
+class RegisterKeyResponse(BaseModel):
+    test_id: str
+    total_questions: int
+    skills: List[str]
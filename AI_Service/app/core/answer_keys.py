@@ -0,0 +1,82 @@
+import os
+from collections import OrderedDict
+from typing import List, Optional
+from app.core.schemas import QuestionKey
+from app.core.grader import NormalizedKey
+
+# ==========================================
+# Cache đáp án theo test id (LRU có giới hạn)
+# ==========================================
+# Mọi học sinh làm cùng một đề dùng chung đáp án: đăng ký một lần, các bài nộp sau chỉ gửi
+# test_id + student_answers => request nhỏ hơn, không validate / chuẩn hóa lại answer_key mỗi lần.
+ANSWER_KEY_CACHE_SIZE = int(os.getenv("ANSWER_KEY_CACHE_SIZE", "500"))
+
+
+class RegisteredKey:
+    """Đáp án của một đề: bản chuẩn hóa cho /grade/ và bản ma trận (tạo khi cần) cho /grade/batch."""
+    __slots__ = ("test_id", "normalized", "compiled")
+
+    def __init__(self, test_id: Optional[str], answer_key: List[QuestionKey]):
+        self.test_id = test_id
+        self.normalized = NormalizedKey(answer_key)
+        self.compiled = None
+
+    def __len__(self):
+        return len(self.normalized)
+
+
+class AnswerKeyRegistry:
+    def __init__(self, max_items: int = ANSWER_KEY_CACHE_SIZE):
+        self.max_items = max_items
+        self._keys: "OrderedDict[str, RegisteredKey]" = OrderedDict()
+        self.stats = {"registered": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def register(self, test_id: str, answer_key: List[QuestionKey]) -> RegisteredKey:
+        """Đăng ký (hoặc thay) đáp án của đề; bỏ đề ít dùng nhất khi đầy."""
+        entry = RegisteredKey(test_id, answer_key)
+        self._keys[test_id] = entry
+        self._keys.move_to_end(test_id)
+        self.stats["registered"] += 1
+        while len(self._keys) > self.max_items:
+            self._keys.popitem(last=False)
+            self.stats["evictions"] += 1
+        return entry
+
+    def get(self, test_id: str) -> Optional[RegisteredKey]:
+        entry = self._keys.get(test_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self._keys.move_to_end(test_id)
+        self.stats["hits"] += 1
+        return entry
+
+    def remove(self, test_id: str) -> bool:
+        return self._keys.pop(test_id, None) is not None
+
+    def resolve(self, test_id: Optional[str], answer_key: Optional[List[QuestionKey]]) -> Optional[RegisteredKey]:
+        """
+        Đáp án dùng để chấm một request:
+        - có answer_key: dùng luôn (kèm test_id thì đăng ký / cập nhật cache cho các bài sau)
+        - chỉ có test_id: lấy từ cache; None nếu đề chưa đăng ký hoặc đã bị đẩy ra khỏi cache
+        """
+        if answer_key:
+            return self.register(test_id, answer_key) if test_id else RegisteredKey(None, answer_key)
+        if test_id:
+            return self.get(test_id)
+        return None
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._keys),
+            "max_items": self.max_items,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+registry = AnswerKeyRegistry()
@@ -0,0 +1,148 @@
+from typing import Dict, List, Optional
+import numpy as np
+from app.core.schemas import QuestionKey
+from app.core.grader import NormalizedKey
+
+# Mã cho ô không có câu trả lời / câu trả lời không khớp đáp án nào trong key
+NO_ANSWER = -1
+UNKNOWN_ANSWER = -2
+
+
+class CompiledKey:
+    """
+    Đáp án đã "biên dịch" thành mảng để chấm nhiều bài cùng lúc:
+    - key_codes[q]: mã của đáp án đúng câu q (chuỗi đã strip/upper, đánh số qua `vocab`)
+    - skill_onehot (Q x K), pair_onehot (Q x P): câu q thuộc kỹ năng k / cặp (kỹ năng, chủ đề) p
+    """
+
+    def __init__(self, key: NormalizedKey):
+        self.ids = key.str_ids
+        self.id_pos = {qid: i for i, qid in enumerate(self.ids)}
+        self.expected = key.expected
+        self.vocab: Dict[str, int] = {}
+        for ans in self.expected:
+            self.vocab.setdefault(ans, len(self.vocab))
+        self.key_codes = np.array([self.vocab[a] for a in self.expected], dtype=np.int32)
+
+        skills = [s or "Unknown" for s in key.skills]
+        self.skill_names = key.skill_names
+        skill_idx = np.array(key.skill_idx, dtype=np.int64)
+        self.skill_onehot = np.zeros((len(skills), len(self.skill_names)), dtype=np.int32)
+        self.skill_onehot[np.arange(len(skills)), skill_idx] = 1
+        self.skill_totals = self.skill_onehot.sum(axis=0)
+
+        # Cặp (kỹ năng, chủ đề) theo thứ tự xuất hiện; câu không có topic không thuộc cặp nào
+        pairs = list(zip(skills, key.topics))
+        self.pair_names = list(dict.fromkeys(p for p in pairs if p[1]))
+        pair_pos = {p: i for i, p in enumerate(self.pair_names)}
+        self.pair_onehot = np.zeros((len(pairs), len(self.pair_names)), dtype=np.int32)
+        self.pair_of = np.full(len(pairs), -1, dtype=np.int64)  # cặp của từng câu (-1: không có topic)
+        for q, p in enumerate(pairs):
+            if p[1]:
+                self.pair_onehot[q, pair_pos[p]] = 1
+                self.pair_of[q] = pair_pos[p]
+        self.pair_totals = self.pair_onehot.sum(axis=0)
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    def encode(self, sheets: List[Dict[str, str]]) -> np.ndarray:
+        """Ma trận học sinh x câu hỏi chứa mã câu trả lời (NO_ANSWER nếu bỏ trống)."""
+        rows = []
+        for answers in sheets:
+            row = [NO_ANSWER] * self.size
+            for qid, ans in answers.items():
+                col = self.id_pos.get(str(qid))
+                if col is not None and ans:
+                    row[col] = self.vocab.get(ans.strip().upper(), UNKNOWN_ANSWER)
+            rows.append(row)
+        return np.array(rows, dtype=np.int32).reshape(len(sheets), self.size)
+
+
+def grade_matrix(key: CompiledKey, sheets: List[Dict[str, str]]) -> Dict[str, np.ndarray]:
+    """Chấm cả lớp bằng phép toán ma trận; trả về các mảng tổng hợp (mỗi hàng một học sinh)."""
+    correct = key.encode(sheets) == key.key_codes          # S x Q (bool)
+    correct_i = correct.astype(np.int32)
+    return {
+        "correct": correct,
+        "total_correct": correct_i.sum(axis=1),              # S
+        "skill_correct": correct_i @ key.skill_onehot,      # S x K
+        "pair_correct": correct_i @ key.pair_onehot,        # S x P
+    }
+
+
+def _accuracy(correct: int, total: int) -> float:
+    return round(correct / total * 100, 2) if total > 0 else 0.0
+
+
+def weak_topics_of(key: CompiledKey, pair_wrong: np.ndarray, correct_row: np.ndarray, limit: int = 3) -> List[str]:
+    """
+    Giống grade_locally: mỗi kỹ năng lấy tối đa 2 chủ đề sai nhiều nhất, tổng cộng tối đa `limit`;
+    hai chủ đề sai bằng nhau thì chủ đề có câu sai xuất hiện trước đứng trước.
+    """
+    # Vị trí câu sai đầu tiên của từng cặp (kỹ năng, chủ đề)
+    wrong_pos = np.flatnonzero(~correct_row)
+    wrong_pairs = key.pair_of[wrong_pos]
+    keep = wrong_pairs >= 0
+    first_wrong = np.full(len(key.pair_names), key.size, dtype=np.int64)
+    pairs, first_idx = np.unique(wrong_pairs[keep], return_index=True)
+    first_wrong[pairs] = wrong_pos[keep][first_idx]
+
+    weak = []
+    for skill in key.skill_names:
+        ranked = sorted(
+            (i for i, (s, _) in enumerate(key.pair_names) if s == skill and pair_wrong[i] > 0),
+            key=lambda i: (-pair_wrong[i], first_wrong[i]),
+        )
+        for i in ranked[:2]:
+            weak.append(f"{skill} - {key.pair_names[i][1]}")
+            if len(weak) >= limit:
+                return weak
+    return weak
+
+
+def grade_batch(answer_key: List[QuestionKey], student_ids: List[str], sheets: List[Dict[str, str]],
+                include_per_question: bool = False, key: Optional[CompiledKey] = None) -> dict:
+    """Chấm nhiều bài với cùng một đáp án; trả về dict khớp BatchGradeResponse."""
+    key = key or CompiledKey(NormalizedKey(answer_key))
+    graded = grade_matrix(key, sheets)
+    pair_wrong = key.pair_totals - graded["pair_correct"]
+
+    results = []
+    for s, student_id in enumerate(student_ids):
+        skill_correct = graded["skill_correct"][s].tolist()
+        pair_correct = graded["pair_correct"][s].tolist()
+        total_correct = int(graded["total_correct"][s])
+        results.append({
+            "student_id": student_id,
+            "total_score": total_correct,
+            "total_questions": key.size,
+            "score_percentage": _accuracy(total_correct, key.size),
+            "skill_summary": [
+                {"skill": name, "total": int(total), "correct": c, "accuracy": _accuracy(c, int(total))}
+                for name, total, c in zip(key.skill_names, key.skill_totals, skill_correct)
+            ],
+            "topic_summary": [
+                {"skill": skill, "topic": topic, "total": int(total), "correct": c, "accuracy": _accuracy(c, int(total))}
+                for (skill, topic), total, c in zip(key.pair_names, key.pair_totals, pair_correct)
+            ],
+            "weak_topics": weak_topics_of(key, pair_wrong[s], graded["correct"][s]),
+            "per_question_correct": graded["correct"][s].tolist() if include_per_question else None,
+        })
+
+    n_students = len(student_ids)
+    class_skill = graded["skill_correct"].sum(axis=0).tolist() if n_students else [0] * len(key.skill_names)
+    return {
+        "total_students": n_students,
+        "total_questions": key.size,
+        "results": results,
+        "average_score_percentage": _accuracy(int(graded["total_correct"].sum()), key.size * n_students),
+        "class_skill_summary": [
+            {"skill": name, "total": int(total) * n_students, "correct": c,
+             "accuracy": _accuracy(c, int(total) * n_students)}
+            for name, total, c in zip(key.skill_names, key.skill_totals, class_skill)
+        ],
+        "question_accuracy": (graded["correct"].mean(axis=0).round(4).tolist() if n_students
+                              else [0.0] * key.size),
+    }
@@ -0,0 +1,45 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+# Số process cho việc nặng CPU (repair JSON, validate, dedup); 0 = luôn chạy inline
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Input nhỏ hơn ngưỡng (ký tự) thì chạy inline: rẻ hơn chi phí pickle + gửi sang process khác
+CPU_OFFLOAD_THRESHOLD = int(os.getenv("CPU_OFFLOAD_THRESHOLD", "4000"))
+
+_executor: Optional[ProcessPoolExecutor] = None
+_stats = {"inline": 0, "offloaded": 0}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS)
+    return _executor
+
+
+async def run_cpu(fn: Callable[..., Any], *args: Any, size: int = 0) -> Any:
+    """
+    Chạy hàm thuần CPU: inline nếu input nhỏ (size < CPU_OFFLOAD_THRESHOLD),
+    ngược lại đẩy sang process pool để không chặn event loop.
+    `fn` và tham số phải pickle được (hàm top-level, dữ liệu thuần).
+    """
+    if CPU_POOL_WORKERS <= 0 or size < CPU_OFFLOAD_THRESHOLD:
+        _stats["inline"] += 1
+        return fn(*args)
+    _stats["offloaded"] += 1
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), fn, *args)
+
+
+def shutdown():
+    """Đóng pool khi app tắt."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def get_stats() -> dict:
+    return {**_stats, "workers": CPU_POOL_WORKERS, "threshold": CPU_OFFLOAD_THRESHOLD}
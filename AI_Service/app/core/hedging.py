@@ -0,0 +1,91 @@
+import os
+import time
+import math
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# --- Cấu hình hedging (mặc định tắt) ---
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+# Batch chạy lâu hơn phân vị này của độ trễ quan sát được thì bắn thêm một request dự phòng
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+# Tỉ lệ hedge tối đa trên tổng số batch (giữ quota Gemini)
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
+# Cần đủ mẫu độ trễ rồi mới hedge
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+
+
+class Hedger:
+    """
+    Chạy một batch, nếu sau `percentile` độ trễ gần đây batch vẫn chưa xong thì bắn thêm
+    một bản sao và lấy kết quả nào xong trước (bản còn lại bị hủy).
+    Kết quả rỗng (batch lỗi) không được tính là "thắng" nếu bản kia vẫn đang chạy.
+    """
+
+    def __init__(self, name: str, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 max_rate: float = HEDGE_MAX_RATE, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.name = name
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self._latencies: deque = deque(maxlen=HEDGE_WINDOW)
+        self.stats = {"batches": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0}
+
+    def hedge_delay(self) -> Optional[float]:
+        """Ngưỡng (giây) để bắn hedge; None nếu chưa đủ dữ liệu."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        idx = min(len(ordered) - 1, math.ceil(self.percentile * len(ordered)) - 1)
+        return ordered[idx]
+
+    def _budget_ok(self) -> bool:
+        return self.stats["hedged"] < self.max_rate * max(1, self.stats["batches"])
+
+    async def run(self, factory: Callable[[], Awaitable[list]]) -> list:
+        self.stats["batches"] += 1
+        started = time.monotonic()
+        primary = asyncio.create_task(factory())
+        tasks = {primary}
+        try:
+            delay = self.hedge_delay() if self.enabled else None
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+
+            if not primary.done() and delay is not None and self._budget_ok():
+                self.stats["hedged"] += 1
+                tasks.add(asyncio.create_task(factory()))
+
+            result: list = []
+            winner = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None and t.result():
+                        result, winner = t.result(), t
+                        break
+                if winner is not None:
+                    break
+
+            # Khi hedge thắng, thời gian này là cận dưới độ trễ của request gốc
+            self._latencies.append(time.monotonic() - started)
+            if len(tasks) > 1 and winner is not None:
+                key = "primary_wins" if winner is primary else "hedge_wins"
+                self.stats[key] += 1
+            return result
+        finally:
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        delay = self.hedge_delay()
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "hedge_rate": round(self.stats["hedged"] / self.stats["batches"], 3) if self.stats["batches"] else 0.0,
+            "hedge_delay_s": round(delay, 2) if delay is not None else None,
+        }
@@ -0,0 +1,216 @@
+import re
+import json
+import time
+from typing import Any, Dict, List, Optional
+import orjson
+from json_repair import repair_json
+from pydantic import ValidationError
+from app.core.schemas import GeneratedQuestion
+from app.core import cpu_pool
+
+
+class QuestionStreamParser:
+    """
+    Parser tăng dần cho output stream của Gemini dạng {"status": ..., "data": [ {...}, {...} ]}
+    (hoặc mảng trần [ {...}, ... ]).
+
+    Gọi feed(chunk) mỗi khi có thêm text; hàm trả về các câu hỏi (dict) vừa hoàn chỉnh,
+    tức là ngay khi dấu "}" đóng object câu hỏi xuất hiện, không cần chờ hết response.
+    Text nằm ngoài JSON (VD: rào ```json) bị bỏ qua.
+    """
+
+    def __init__(self):
+        self._stack: List[str] = []      # các container đang mở: "{" hoặc "["
+        self._in_string = False
+        self._escape = False
+        self._item: Optional[List[str]] = None  # ký tự của object câu hỏi đang đọc
+        self._item_depth = 0
+        self._chunks: List[str] = []
+        self.emitted = 0
+
+    @property
+    def text(self) -> str:
+        """Toàn bộ text đã nhận (dùng cho fallback parse cả batch)."""
+        return "".join(self._chunks)
+
+    def _at_item_level(self) -> bool:
+        # Object câu hỏi là phần tử của mảng top-level, hoặc của mảng nằm ngay trong object top-level ("data")
+        return self._stack == ["["] or self._stack == ["{", "["]
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        done = [q for q in (parse_question(raw) for raw in self._scan(chunk)) if q is not None]
+        # Chỉ đếm câu hợp lệ: emitted == 0 là tín hiệu fallback parse cả batch, và là số liệu cho batch planner
+        self.emitted += len(done)
+        return done
+
+    async def afeed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Như feed(), nhưng object hỏng lớn được repair ở process pool thay vì chặn event loop."""
+        done = []
+        for raw in self._scan(chunk):
+            obj = await parse_question_async(raw)
+            if obj is not None:
+                done.append(obj)
+        self.emitted += len(done)
+        return done
+
+    def _scan(self, chunk: str) -> List[str]:
+        """Đọc thêm chunk, trả về text thô của các object câu hỏi vừa đóng."""
+        self._chunks.append(chunk)
+        done: List[str] = []
+
+        for ch in chunk:
+            if self._item is not None:
+                self._item.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                if self._stack:
+                    self._in_string = True
+            elif ch in "{[":
+                if ch == "{" and self._item is None and self._at_item_level():
+                    self._item = [ch]
+                    self._item_depth = len(self._stack) + 1
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if self._item is not None and ch == "}" and len(self._stack) == self._item_depth - 1:
+                    done.append("".join(self._item))
+                    self._item = None
+
+        return done
+
+
+# Số liệu parse: phần lớn phải đi đường nhanh; "repaired" tăng nghĩa là structured output đang không hiệu quả
+parse_stats = {"fast": 0, "repaired": 0, "failed": 0, "invalid": 0, "repair_ms": 0.0}
+
+
+def _new_stats() -> Dict[str, Any]:
+    return {"fast": 0, "repaired": 0, "failed": 0, "invalid": 0, "repair_ms": 0.0}
+
+
+def _merge_stats(delta: Dict[str, Any]):
+    """Cộng số liệu do worker process trả về (biến toàn cục của worker không về được process chính)."""
+    for key, value in delta.items():
+        parse_stats[key] += value
+
+
+def loads(raw: str, stats: Optional[Dict[str, Any]] = None) -> Any:
+    """Parse JSON: orjson trước, lỗi cú pháp thì repair_json (có đo thời gian). None nếu bó tay."""
+    stats = parse_stats if stats is None else stats
+    try:
+        obj = orjson.loads(raw)
+        stats["fast"] += 1
+        return obj
+    except orjson.JSONDecodeError:
+        pass
+
+    started = time.perf_counter()
+    try:
+        obj = json.loads(repair_json(raw))
+        stats["repaired"] += 1
+        return obj
+    except Exception:
+        stats["failed"] += 1
+        return None
+    finally:
+        stats["repair_ms"] += (time.perf_counter() - started) * 1000
+
+
+def to_question(obj: Any, stats: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Validate theo GeneratedQuestion; trả về dict đã chuẩn hóa hoặc None nếu không hợp lệ."""
+    stats = parse_stats if stats is None else stats
+    try:
+        question = GeneratedQuestion.model_validate(obj)
+    except ValidationError:
+        stats["invalid"] += 1
+        return None
+    if not question.question.strip() or not question.answer.strip():
+        stats["invalid"] += 1
+        return None
+    return question.model_dump()
+
+
+def parse_question(raw: str, stats: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Parse + validate một object câu hỏi."""
+    obj = loads(raw, stats)
+    return to_question(obj, stats) if obj is not None else None
+
+
+def _strip_fences(text: str) -> str:
+    return re.sub(r"^```(?:json)?|```$", "", (text or "").strip(), flags=re.MULTILINE).strip()
+
+
+def _dedupe(questions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Bỏ câu trùng nguyên văn trong cùng một batch (so sánh không phân biệt hoa thường/khoảng trắng)."""
+    seen = set()
+    unique = []
+    for q in questions:
+        key = " ".join(q["question"].lower().split())
+        if key not in seen:
+            seen.add(key)
+            unique.append(q)
+    return unique
+
+
+def parse_batch_text(text: str, stats: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Fallback: parse cả output của một batch ({"data": [...]} hoặc [...]), bỏ rào ```json nếu có."""
+    clean_text = _strip_fences(text)
+    if not clean_text:
+        return []
+    data = loads(clean_text, stats)
+    if isinstance(data, dict):
+        data = data.get("data", [])
+    if not isinstance(data, list):
+        return []
+    return _dedupe([q for q in (to_question(obj, stats) for obj in data) if q is not None])
+
+
+# ==========================================
+# Bản async: phần nặng CPU chạy ở process pool
+# ==========================================
+def _parse_question_worker(raw: str):
+    stats = _new_stats()
+    return parse_question(raw, stats), stats
+
+
+def _parse_batch_worker(text: str):
+    stats = _new_stats()
+    return parse_batch_text(text, stats), stats
+
+
+async def parse_question_async(raw: str) -> Optional[Dict[str, Any]]:
+    """Object hợp lệ đi đường nhanh ngay trên event loop; chỉ object hỏng và lớn mới sang pool."""
+    try:
+        obj = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        question, stats = await cpu_pool.run_cpu(_parse_question_worker, raw, size=len(raw))
+        _merge_stats(stats)
+        return question
+    parse_stats["fast"] += 1
+    return to_question(obj)
+
+
+async def parse_batch_text_async(text: str) -> List[Dict[str, Any]]:
+    """parse_batch_text() không chặn event loop: output dài (repair + validate + dedup) chạy ở process pool."""
+    text = text or ""
+    questions, stats = await cpu_pool.run_cpu(_parse_batch_worker, text, size=len(text))
+    _merge_stats(stats)
+    return questions
+
+
+def get_parse_stats() -> Dict[str, Any]:
+    total = parse_stats["fast"] + parse_stats["repaired"] + parse_stats["failed"]
+    return {
+        **parse_stats,
+        "repair_ms": round(parse_stats["repair_ms"], 1),
+        "fast_ratio": round(parse_stats["fast"] / total, 3) if total else 0.0,
+    }
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from app.core.schemas import LearningProfile, TrendState
+from app.core.trend import update_trend, trend_from_history
+
+# ==========================================
+# Kho hồ sơ học viên (SQLite cục bộ thay cho DB thật + LRU hồ sơ "nóng")
+# ==========================================
+# Grader tự giữ profile + lịch sử rút gọn theo student_id => request chỉ cần student_id,
+# không phải gửi lại cả test_history (kèm per_question) mỗi lần chấm.
+PROFILE_DB_PATH = os.getenv("PROFILE_DB_PATH", "cache/profiles.sqlite3")
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "1000"))
+# Số bài gần nhất đưa vào profile gửi Gemini (toàn bộ bài vẫn nằm trong bảng attempts)
+PROFILE_HISTORY_LIMIT = int(os.getenv("PROFILE_HISTORY_LIMIT", "20"))
+
+
+def attempt_summary(item: Any) -> Dict[str, Any]:
+    """Bản rút gọn của một bài làm (không có per_question): vài trăm byte thay vì vài chục KB."""
+    data = item if isinstance(item, dict) else item.model_dump()
+    return {
+        "test_date": data.get("test_date"),
+        "test_id": data.get("test_id"),
+        "title": data.get("title"),
+        "level_at_test": data.get("level_at_test") or "Unknown",
+        "total_score": data.get("total_score") or 0,
+        "total_questions": data.get("total_questions") or 0,
+        "score_percentage": round(float(data.get("score_percentage") or 0.0), 2),
+        "weak_topics": list(data.get("weak_topics") or []),
+        "skill_accuracy": dict(data.get("skill_accuracy") or {}),
+    }
+
+
+class ProfileStore:
+    """
+    profiles: một dòng / học viên (thông tin profile + trend_state + version); attempts: mỗi bài một dòng (JSON rút gọn).
+    SQLite là nguồn sự thật: mọi lần ghi là một transaction BEGIN IMMEDIATE (đọc + cập nhật trend_state
+    trong cùng transaction), nên nhiều worker uvicorn dùng chung file DB vẫn không ghi đè nhau.
+    LRU chỉ dùng cho đọc (profile + trend_state + PROFILE_HISTORY_LIMIT bài gần nhất); mỗi lần đọc so
+    `version` với DB, worker khác đã ghi thì nạp lại.
+    Các hàm đều là sync (sqlite3); gọi qua asyncio.to_thread từ code async.
+    """
+
+    def __init__(self, path: str = PROFILE_DB_PATH, max_cached: int = PROFILE_CACHE_SIZE,
+                 history_limit: int = PROFILE_HISTORY_LIMIT):
+        self.max_cached = max_cached
+        self.history_limit = history_limit
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "attempts_saved": 0}
+        self._hot: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # isolation_level=None: tự quản lý transaction (BEGIN IMMEDIATE) thay vì để sqlite3 mở ngầm
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS profiles ("
+            " student_id TEXT PRIMARY KEY, profile TEXT NOT NULL, trend TEXT, updated_at REAL NOT NULL,"
+            " version INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(profiles)")}
+        if "version" not in columns:  # DB tạo từ bản trước chưa có cột version
+            self._conn.execute("ALTER TABLE profiles ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS attempts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, student_id TEXT NOT NULL,"
+            " payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_attempts_student ON attempts(student_id, id)")
+
+    # --- LRU hồ sơ nóng (chỉ để đọc) ---
+    def _remember(self, student_id: str, entry: Dict[str, Any]):
+        self._hot[student_id] = entry
+        self._hot.move_to_end(student_id)
+        while len(self._hot) > self.max_cached:
+            self._hot.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _read_row(self, student_id: str) -> Optional[tuple]:
+        return self._conn.execute(
+            "SELECT profile, trend, version FROM profiles WHERE student_id = ?", (student_id,)
+        ).fetchone()
+
+    def _load(self, student_id: str) -> Optional[Dict[str, Any]]:
+        version = self._conn.execute(
+            "SELECT version FROM profiles WHERE student_id = ?", (student_id,)
+        ).fetchone()
+        if version is None:
+            self._hot.pop(student_id, None)
+            return None
+        entry = self._hot.get(student_id)
+        if entry is not None and entry["version"] == version[0]:
+            self._hot.move_to_end(student_id)
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        row = self._read_row(student_id)
+        rows = self._conn.execute(
+            "SELECT payload FROM attempts WHERE student_id = ? ORDER BY id DESC LIMIT ?",
+            (student_id, self.history_limit),
+        ).fetchall()
+        entry = {
+            "profile": json.loads(row[0]),
+            "trend_state": json.loads(row[1]) if row[1] else None,
+            "test_history": [json.loads(r[0]) for r in reversed(rows)],
+            "version": row[2],
+        }
+        self._remember(student_id, entry)
+        return entry
+
+    def _write(self, fn):
+        """Chạy fn() trong một transaction BEGIN IMMEDIATE (khóa ghi của cả file DB, kể cả với process khác)."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn()
+            self._conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _insert_attempts(self, student_id: str, summaries: List[Dict[str, Any]]):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT INTO attempts (student_id, payload, created_at) VALUES (?, ?, ?)",
+            [(student_id, json.dumps(h, ensure_ascii=False), now) for h in summaries],
+        )
+
+    def _upsert_profile(self, student_id: str, profile: Dict[str, Any], trend: Optional[Dict[str, Any]]):
+        self._conn.execute(
+            "INSERT INTO profiles (student_id, profile, trend, updated_at, version) VALUES (?, ?, ?, ?, 1)"
+            " ON CONFLICT(student_id) DO UPDATE SET profile = excluded.profile, trend = excluded.trend,"
+            " updated_at = excluded.updated_at, version = profiles.version + 1",
+            (student_id, json.dumps(profile, ensure_ascii=False),
+             json.dumps(trend) if trend else None, time.time()),
+        )
+
+    # --- API ---
+    def get(self, student_id: str) -> Optional[Dict[str, Any]]:
+        """{"profile": {...}, "trend_state": {...} | None, "test_history": [bài rút gọn gần nhất]} hoặc None."""
+        with self._lock:
+            entry = self._load(student_id)
+            return _copy(entry) if entry else None
+
+    def save_profile(self, profile: LearningProfile) -> Dict[str, Any]:
+        """
+        Lưu / cập nhật thông tin profile. Lần đầu gặp học viên thì nhập luôn test_history kiểu cũ
+        (rút gọn) và dựng trend_state một lần; các lần sau test_history gửi kèm bị bỏ qua.
+        """
+        student_id = profile.student_id
+        info = profile.model_dump(exclude={"test_history"})
+
+        def write():
+            row = self._read_row(student_id)
+            if row is None:
+                history = [attempt_summary(h) for h in profile.test_history]
+                self._insert_attempts(student_id, history)
+                trend = trend_from_history(history).model_dump() if history else None
+            else:
+                trend = json.loads(row[1]) if row[1] else None
+            self._upsert_profile(student_id, info, trend)
+
+        with self._lock:
+            self._write(write)
+            return _copy(self._load(student_id))
+
+    def append_attempt(self, student_id: str, summary: Dict[str, Any], score: float,
+                       prior: Optional[TrendState] = None) -> TrendState:
+        """
+        Ghi thêm một bài đã chấm (bản rút gọn) và cộng điểm vào trend_state đọc ngay từ DB trong cùng
+        transaction, nên các bài nộp song song (kể cả ở worker khác) không ghi đè nhau.
+        `prior` chỉ dùng khi kho chưa có trend_state. Tạo hồ sơ rỗng nếu chưa có; trả về trend_state mới.
+        """
+        def write():
+            row = self._read_row(student_id)
+            profile = json.loads(row[0]) if row else {"student_id": student_id}
+            base = TrendState(**json.loads(row[1])) if row and row[1] else (prior or TrendState())
+            trend = update_trend(base, score)
+            self._insert_attempts(student_id, [summary])
+            self._upsert_profile(student_id, profile, trend.model_dump())
+            return trend
+
+        with self._lock:
+            trend = self._write(write)
+            self.stats["attempts_saved"] += 1
+            return trend
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            profiles = self._conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+            attempts = self._conn.execute("SELECT COUNT(*) FROM attempts").fetchone()[0]
+            cached = len(self._hot)
+        return {**self.stats, "profiles": profiles, "attempts": attempts,
+                "cached": cached, "max_cached": self.max_cached}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _copy(entry: Dict[str, Any]) -> Dict[str, Any]:
+    # Bản sao nông đủ dùng: caller không sửa trực tiếp list / dict bên trong entry trong LRU
+    return {
+        "profile": dict(entry["profile"]),
+        "trend_state": dict(entry["trend_state"]) if entry["trend_state"] else None,
+        "test_history": list(entry["test_history"]),
+    }
+
+
+_store: Optional[ProfileStore] = None
+
+
+def get_store() -> ProfileStore:
+    """Kho hồ sơ dùng chung của process (mở file SQLite ở lần dùng đầu tiên)."""
+    global _store
+    if _store is None:
+        _store = ProfileStore()
+    return _store
+
+
+def close_store():
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
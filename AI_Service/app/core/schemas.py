@@ -1,5 +1,5 @@
 from typing import List, Dict, Optional, Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from datetime import date
 
 # ==========================================
@@ -104,12 +104,28 @@ class LearningProfile(BaseModel):
     study_methods: List[str]
     test_history: List[TestHistoryItem]
 
+class TrendState(BaseModel):
+    """Thống kê xu hướng cộng dồn của một học sinh (cập nhật O(1) mỗi bài; backend lưu lại và gửi kèm lần sau)."""
+    count: int = 0
+    first_score: float = 0.0
+    last_score: float = 0.0
+    mean: float = 0.0
+    m2: float = 0.0  # tổng bình phương độ lệch (Welford) => phương sai = m2 / (count - 1)
+    recent_scores: List[float] = []  # N điểm gần nhất (TREND_WINDOW) để vẽ biểu đồ
+
 class GradeRequest(BaseModel):
     test_info: Optional[TestInfo] = None
-    answer_key: List[QuestionKey]
+    # Đề đã đăng ký (POST /grade/keys) => chỉ cần test_id, không phải gửi lại answer_key
+    test_id: Optional[str] = None
+    answer_key: Optional[List[QuestionKey]] = None
     student_answers: Dict[str, str]
     use_gemini: Optional[bool] = False
-    profile: Optional[LearningProfile]
+    # Học viên đã có hồ sơ trong kho của grader (POST /grade/profiles) => chỉ cần student_id
+    student_id: Optional[str] = None
+    profile: Optional[LearningProfile] = None
+    # Có trend_state (lấy từ response lần trước) => không cần đọc lại toàn bộ test_history để tính xu hướng
+    trend_state: Optional[TrendState] = None
+    include_explanations: Optional[bool] = True  # False => bỏ câu giải thích từng câu (đề dài chấm nhanh hơn)
 
 class GradeResponse(BaseModel):
     total_score: int
@@ -126,4 +142,81 @@ class GradeResponse(BaseModel):
     
     # [THÊM] Hứng thêm dữ liệu từ AI
     proficiency_prediction: Optional[ProficiencyPrediction] = None 
-    monitoring_alerts: Optional[List[str]] = []
\ No newline at end of file
+    monitoring_alerts: Optional[List[str]] = []
+
+    # Trạng thái xu hướng đã gồm bài này: backend lưu lại và gửi kèm ở lần chấm sau
+    trend_state: Optional[TrendState] = None
+
+class RegisterKeyRequest(BaseModel):
+    test_id: str
+    answer_key: List[QuestionKey]
+
+class RegisterKeyResponse(BaseModel):
+    test_id: str
+    total_questions: int
+    skills: List[str]
+
+# ==========================================
+# 4. CÂU HỎI DO GEMINI SINH RA (dùng làm response_schema)
+# ==========================================
+# Lưu ý: không đặt default cho field vì Gemini API không nhận default trong response_schema
+
+class GeneratedQuestion(BaseModel):
+    type: str
+    skill: str
+    topic: List[str]
+    question: str
+    options: List[str]
+    answer: str
+    explanation: str
+
+    @field_validator("topic", mode="before")
+    @classmethod
+    def _topic_as_list(cls, v):
+        # Output cũ / output đã repair đôi khi trả topic là chuỗi
+        return [v] if isinstance(v, str) else v
+
+class QuestionBatch(BaseModel):
+    status: str
+    data: List[GeneratedQuestion]
+
+# ==========================================
+# 5. CHẤM ĐIỂM HÀNG LOẠT (cả lớp, một đáp án chung, chỉ chấm local)
+# ==========================================
+
+class TopicSummary(BaseModel):
+    skill: str
+    topic: str
+    total: int
+    correct: int
+    accuracy: float
+
+class StudentSheet(BaseModel):
+    student_id: str
+    student_answers: Dict[str, str]
+
+class BatchGradeRequest(BaseModel):
+    test_info: Optional[TestInfo] = None
+    test_id: Optional[str] = None
+    answer_key: Optional[List[QuestionKey]] = None
+    submissions: List[StudentSheet]
+    include_per_question: Optional[bool] = False  # True => trả thêm mảng đúng/sai từng câu
+
+class StudentGradeResult(BaseModel):
+    student_id: str
+    total_score: int
+    total_questions: int
+    score_percentage: float
+    skill_summary: List[SkillSummary]
+    topic_summary: List[TopicSummary]
+    weak_topics: List[str]
+    per_question_correct: Optional[List[bool]] = None
+
+class BatchGradeResponse(BaseModel):
+    total_students: int
+    total_questions: int
+    results: List[StudentGradeResult]
+    # Thống kê cả lớp
+    average_score_percentage: float
+    class_skill_summary: List[SkillSummary]
+    question_accuracy: List[float]  # tỉ lệ làm đúng từng câu (theo thứ tự answer_key)
@@ -0,0 +1,61 @@
+import copy
+import json
+import random
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict
+
+
+def make_key(params: Dict[str, Any]) -> str:
+    """Hash của tham số request đã chuẩn hóa (thứ tự key không quan trọng)."""
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def reshuffle(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Bản sao kết quả {"data": [...]} với thứ tự câu và đáp án được xáo lại."""
+    result = copy.deepcopy(result)
+    questions = result.get("data")
+    if isinstance(questions, list):
+        random.shuffle(questions)
+        for q in questions:
+            if isinstance(q, dict) and isinstance(q.get("options"), list):
+                random.shuffle(q["options"])
+    return result
+
+
+class SingleFlight:
+    """
+    Gộp các request giống nhau đang chạy đồng thời: request đầu tiên (leader) thực sự gọi
+    `call`, các request đến sau với cùng key (follower) chờ chung kết quả đó.
+    Task chạy độc lập với request gốc (shield), nên leader ngắt kết nối cũng không hủy
+    generation mà follower đang chờ.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]):
+        """Trả về (kết quả, is_leader). Exception của `call` được ném lại cho mọi request đang chờ."""
+        task = self._inflight.get(key)
+        is_leader = task is None
+        if is_leader:
+            task = asyncio.create_task(call())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+        return await asyncio.shield(task), is_leader
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Tránh cảnh báo "exception was never retrieved" khi không còn ai chờ
+        if not task.cancelled():
+            task.exception()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "inflight": len(self._inflight)}
@@ -0,0 +1,83 @@
+import re
+import hashlib
+from typing import Dict, List, Optional
+
+# Bối cảnh xoay vòng giữa các batch để các batch cùng chủ đề không sinh ra câu na ná nhau
+CONTEXTS = [
+    "office and meetings", "travel and transportation", "shopping and customer service",
+    "health and fitness", "technology and the internet", "education and training",
+    "finance and banking", "restaurants and hospitality", "entertainment and media",
+    "manufacturing and logistics", "housing and daily life", "marketing and sales",
+]
+
+
+def split_topics(topic) -> List[str]:
+    """'Tenses, Conditionals; Passive' hoặc list => ['Tenses', 'Conditionals', 'Passive'] (giữ thứ tự, bỏ trùng)."""
+    items = topic if isinstance(topic, list) else re.split(r"[,;|/\n]", topic or "")
+    seen = {}
+    for item in items:
+        item = " ".join(str(item).split())
+        if item and item.lower() not in seen:
+            seen[item.lower()] = item
+    return list(seen.values())
+
+
+def type_quota(total: int, question_types: List[str], ratio: Optional[Dict[str, float]] = None) -> Dict[str, int]:
+    """
+    Số câu mỗi loại cho cả đề theo tỉ lệ (mặc định chia đều), làm tròn kiểu largest remainder
+    để tổng luôn bằng total. VD: (10, ["multiple_choice", "fill_in_blank"], {"multiple_choice": 70}) => {7, 3}
+    """
+    if total <= 0 or not question_types:
+        return {}
+    weights = {t: float((ratio or {}).get(t, 0 if ratio else 1)) for t in question_types}
+    if sum(weights.values()) <= 0:
+        weights = {t: 1.0 for t in question_types}
+    scale = total / sum(weights.values())
+    exact = {t: w * scale for t, w in weights.items()}
+    counts = {t: int(v) for t, v in exact.items()}
+    by_remainder = sorted(question_types, key=lambda t: exact[t] - counts[t], reverse=True)
+    for t in by_remainder[:total - sum(counts.values())]:
+        counts[t] += 1
+    return {t: n for t, n in counts.items() if n > 0}
+
+
+def plan_slices(sizes: List[int], sub_topics: List[str], counts: Dict[str, int], seed: str) -> List[dict]:
+    """
+    Giao cho mỗi batch một phần riêng của đề:
+      {"size": n, "sub_topics": [...], "type_counts": {loại: số câu}, "context": "...", "seed": "..."}
+    - Loại câu hỏi được chia xen kẽ nên tổng các batch đúng bằng `counts` (không cần sinh dư rồi bỏ).
+    - Sub-topic chia vòng tròn giữa các batch; bối cảnh và seed khác nhau ở mỗi batch.
+    """
+    # Xếp xen kẽ các loại theo đúng tỉ lệ: {mc: 3, fib: 2} => [mc, fib, mc, fib, mc]
+    # (mỗi vị trí chọn loại đang bị "thiếu" nhiều nhất so với tỉ lệ => batch nào cũng có tỉ lệ gần với cả đề)
+    total = sum(counts.values())
+    assigned = {t: 0 for t in counts}
+    labels = []
+    for k in range(1, total + 1):
+        t = max(counts, key=lambda t: counts[t] * k / total - assigned[t])
+        assigned[t] += 1
+        labels.append(t)
+
+    # Băm cả chuỗi seed (gồm hậu tố ":{round_no}") => vòng bù có seed / bối cảnh khác vòng đầu
+    seed_hash = hashlib.sha1(seed.encode()).hexdigest()
+    digest = int(seed_hash, 16)
+    n_batches = len(sizes)
+    slices = []
+    pos = 0
+    for i, size in enumerate(sizes):
+        type_counts: Dict[str, int] = {}
+        for t in labels[pos:pos + size]:
+            type_counts[t] = type_counts.get(t, 0) + 1
+        pos += size
+        if len(sub_topics) >= n_batches:
+            topics = sub_topics[i::n_batches]
+        else:
+            topics = [sub_topics[i % len(sub_topics)]] if sub_topics else []
+        slices.append({
+            "size": size,
+            "sub_topics": topics,
+            "type_counts": type_counts,
+            "context": CONTEXTS[(digest + i) % len(CONTEXTS)],
+            "seed": f"{seed_hash[:8]}-{i + 1}",
+        })
+    return slices
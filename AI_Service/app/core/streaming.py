@@ -0,0 +1,34 @@
+import json
+from typing import Any, AsyncIterator, Dict
+from fastapi.responses import StreamingResponse
+
+# Hai định dạng stream hỗ trợ: NDJSON (mỗi dòng 1 JSON) và Server-Sent Events
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def encode_event(payload: Dict[str, Any], fmt: str = "ndjson") -> str:
+    """Mã hóa một event thành chuỗi theo định dạng stream (event name lấy từ payload["event"])."""
+    data = json.dumps(payload, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {payload.get('event', 'message')}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+def stream_events(events: AsyncIterator[Dict[str, Any]], fmt: str = "ndjson") -> StreamingResponse:
+    """Bọc async generator các event thành StreamingResponse."""
+    if fmt not in MEDIA_TYPES:
+        fmt = "ndjson"
+
+    async def body():
+        async for payload in events:
+            yield encode_event(payload, fmt)
+
+    return StreamingResponse(
+        body(),
+        media_type=MEDIA_TYPES[fmt],
+        # Tắt buffer của proxy (nginx) để câu hỏi tới client ngay khi có
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,145 @@
+import os
+import copy
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+
+# --- Cấu hình cache đề đã sinh (lưu trên đĩa, sống qua restart) ---
+TEST_CACHE_ENABLED = os.getenv("TEST_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+TEST_CACHE_PATH = os.getenv("TEST_CACHE_PATH", "cache/generated_tests.sqlite3")
+TEST_CACHE_TTL = int(os.getenv("TEST_CACHE_TTL", str(7 * 24 * 3600)))           # giây
+TEST_CACHE_MAX_BYTES = int(os.getenv("TEST_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# Số câu tối đa giữ cho mỗi key; pool lớn hơn số câu yêu cầu để mỗi lần hit lấy một tập con khác nhau
+TEST_CACHE_POOL_SIZE = int(os.getenv("TEST_CACHE_POOL_SIZE", "60"))
+
+
+def make_key(params: Dict[str, Any], version: str) -> str:
+    """Key = hash của tham số đã chuẩn hóa + phiên bản prompt template."""
+    raw = json.dumps({"v": version, "p": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def fresh_sample(pool: List[Dict[str, Any]], k: int) -> List[Dict[str, Any]]:
+    """Lấy ngẫu nhiên k câu từ pool (bản sao), xáo thứ tự câu và thứ tự đáp án để đề trông mới."""
+    picked = copy.deepcopy(random.sample(pool, min(k, len(pool))))
+    for question in picked:
+        if isinstance(question.get("options"), list):
+            random.shuffle(question["options"])
+    return picked
+
+
+class TestCache:
+    """
+    Cache SQLite: mỗi key giữ một pool câu hỏi, có TTL và giới hạn tổng dung lượng (xóa theo LRU).
+    Các hàm đều là sync (sqlite3); gọi qua asyncio.to_thread từ code async.
+    """
+
+    def __init__(self, path: str = TEST_CACHE_PATH, ttl: int = TEST_CACHE_TTL,
+                 max_bytes: int = TEST_CACHE_MAX_BYTES, pool_size: int = TEST_CACHE_POOL_SIZE):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, payload TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed_at)")
+        self._conn.commit()
+
+    def _load(self, key: str, now: float) -> Optional[tuple]:
+        row = self._conn.execute(
+            "SELECT payload, created_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row and now - row[1] > self.ttl:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        return row
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Trả về pool câu hỏi của key (None nếu chưa có / hết hạn)."""
+        now = time.time()
+        with self._lock:
+            row = self._load(key, now)
+            if not row:
+                self.stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+            return json.loads(row[0])
+
+    def add(self, key: str, questions: List[Dict[str, Any]]):
+        """Gộp câu mới vào pool của key (bỏ câu trùng nội dung), giữ tối đa pool_size câu mới nhất."""
+        if not questions:
+            return
+        now = time.time()
+        with self._lock:
+            row = self._load(key, now)
+            pool = json.loads(row[0]) if row else []
+            created_at = row[1] if row else now
+
+            seen = {q.get("question") for q in pool}
+            added = 0
+            for q in questions:
+                if q.get("question") not in seen:
+                    pool.append(q)
+                    seen.add(q.get("question"))
+                    added += 1
+            pool = pool[-self.pool_size:]
+            # Pool vừa được bổ sung câu mới => tính TTL lại từ bây giờ (câu cũ nhất bị đẩy ra theo pool_size),
+            # tránh cả pool đang được làm mới hết hạn cùng lúc theo thời điểm tạo ban đầu
+            if added:
+                created_at = now
+
+            payload = json.dumps(pool, ensure_ascii=False)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, payload, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload.encode("utf-8")), created_at, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Xóa entry ít được dùng nhất cho tới khi tổng dung lượng <= max_bytes."""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {**self.stats, "entries": entries, "bytes": total, "max_bytes": self.max_bytes}
+
+
+_cache: Optional[TestCache] = None
+
+
+def get_cache() -> Optional[TestCache]:
+    """Cache dùng chung của process (None nếu bị tắt bằng TEST_CACHE_ENABLED=false)."""
+    global _cache
+    if TEST_CACHE_ENABLED and _cache is None:
+        _cache = TestCache()
+    return _cache
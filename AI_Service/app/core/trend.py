@@ -0,0 +1,71 @@
+import os
+import math
+from typing import Any, List, Optional
+from app.core.schemas import TrendState
+
+# Số điểm gần nhất giữ lại trong scores_trajectory (phần còn lại chỉ sống trong count/mean/m2)
+TREND_WINDOW = int(os.getenv("TREND_WINDOW", "20"))
+
+
+def _score_of(item: Any) -> Optional[float]:
+    # Lịch sử có thể là Pydantic model hoặc dict
+    if hasattr(item, "score_percentage"):
+        val = item.score_percentage
+    elif isinstance(item, dict):
+        val = item.get("score_percentage")
+    else:
+        val = None
+    return float(val) if val is not None else None
+
+
+def update_trend(state: TrendState, score: float, window: int = TREND_WINDOW) -> TrendState:
+    """Thêm một điểm vào trạng thái (Welford): O(1), không cần dãy điểm cũ. Trả về state mới."""
+    score = float(score)
+    count = state.count + 1
+    delta = score - state.mean
+    mean = state.mean + delta / count
+    return TrendState(
+        count=count,
+        first_score=state.first_score if state.count else score,
+        last_score=score,
+        mean=mean,
+        m2=state.m2 + delta * (score - mean),
+        recent_scores=(state.recent_scores + [score])[-window:],
+    )
+
+
+def trend_from_history(history: List[Any]) -> TrendState:
+    """Dựng trạng thái từ test_history kiểu cũ (chỉ cần một lần cho học sinh chưa có trend_state)."""
+    state = TrendState()
+    for h in history or []:
+        score = _score_of(h)
+        if score is not None:
+            state = update_trend(state, score)
+    return state
+
+
+def calculate_trend_metrics(state: TrendState) -> dict:
+    """
+    Xu hướng học tập từ trạng thái đã gồm bài hiện tại:
+    - accuracy_growth_rate = (điểm mới nhất - điểm đầu tiên) / số bài; dương là tăng, âm là giảm
+    - consistency_index = 1 - stdev / 25 (độ lệch > 25% coi như rất mất ổn định => 0.0)
+    """
+    n = state.count
+    if n < 2:
+        return {
+            "past_tests": 0,
+            "accuracy_growth_rate": 0.0,
+            "consistency_index": 1.0,  # 1 bài thì coi như ổn định tuyệt đối
+            "scores_trajectory": state.recent_scores,
+        }
+
+    growth_rate = (state.last_score - state.first_score) / n
+    stdev = math.sqrt(max(state.m2, 0.0) / (n - 1))
+    consistency = max(0.0, 1.0 - (stdev / 25.0))
+
+    return {
+        "past_tests": n - 1,
+        "accuracy_growth_rate": round(growth_rate, 2),
+        "consistency_index": round(consistency, 2),
+        "scores_trajectory": state.recent_scores,  # Gửi dãy điểm gần nhất cho AI tham khảo
+    }
@@ -1,8 +1,27 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import topic_test, custom_test, grader_router
+from app.core.gemini_client import init_http_client, close_http_client, get_pool_stats
+from app.core import gemini_scheduler, test_cache, cpu_pool, dedup
+from app.core.answer_keys import registry as answer_keys
+from app.core.profile_store import get_store, close_store
+from app.core.batch_planner import planner
+from app.core.json_stream import get_parse_stats
+from app.services import render_custom, render_topic
 
-app = FastAPI(title="AI English Test Generator")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Mở connection pool tới Gemini một lần cho cả vòng đời app
+    await init_http_client()
+    yield
+    await close_http_client()
+    cpu_pool.shutdown()
+    close_store()
+
+
+app = FastAPI(title="AI English Test Generator", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,3 +39,50 @@ app.include_router(grader_router.router)
 @app.get("/")
 async def root():
     return {"message": "AI English Test API is running 🚀"}
+
+@app.get("/metrics/gemini-http")
+async def gemini_http_metrics():
+    return get_pool_stats()
+
+@app.get("/metrics/gemini-scheduler")
+async def gemini_scheduler_metrics():
+    return gemini_scheduler.get_stats()
+
+@app.get("/metrics/test-cache")
+async def test_cache_metrics():
+    cache = test_cache.get_cache()
+    return cache.get_stats() if cache else {"enabled": False}
+
+@app.get("/metrics/singleflight")
+async def singleflight_metrics():
+    return {
+        render_custom.inflight.name: render_custom.inflight.get_stats(),
+        render_topic.inflight.name: render_topic.inflight.get_stats(),
+    }
+
+@app.get("/metrics/hedging")
+async def hedging_metrics():
+    return {
+        render_custom.hedger.name: render_custom.hedger.get_stats(),
+        render_topic.hedger.name: render_topic.hedger.get_stats(),
+    }
+
+@app.get("/metrics/batch-planner")
+async def batch_planner_metrics():
+    return planner.get_stats()
+
+@app.get("/metrics/parser")
+async def parser_metrics():
+    return {**get_parse_stats(), "cpu_pool": cpu_pool.get_stats()}
+
+@app.get("/metrics/dedup")
+async def dedup_metrics():
+    return dedup.get_stats()
+
+@app.get("/metrics/answer-keys")
+async def answer_key_metrics():
+    return answer_keys.get_stats()
+
+@app.get("/metrics/profiles")
+async def profile_metrics():
+    return get_store().get_stats()
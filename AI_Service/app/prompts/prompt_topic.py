@@ -1,12 +1,22 @@
+# Tăng khi sửa nội dung prompt để cache đề cũ (app/core/test_cache.py) không còn được dùng
+PROMPT_VERSION = "topic-v2"
+
+DEFAULT_QUESTION_TYPES = ["multiple_choice", "fill_in_blank", "rearrange", "essay"]
+
+
 def generate_test_prompt(
     topic: str,
     question_types: list = None,
     num_questions: int = 10,
     exam_type: str = "TOEIC",
-    score_range: str = None
+    score_range: str = None,
+    sub_topics: list = None,
+    type_counts: dict = None,
+    context: str = None,
+    seed: str = None
 ):
     if question_types is None:
-        question_types = ["multiple_choice", "fill_in_blank", "rearrange", "essay"]
+        question_types = DEFAULT_QUESTION_TYPES
 
     types_text = {
         "multiple_choice": "Multiple-choice (4 options)",
@@ -17,6 +27,22 @@ def generate_test_prompt(
 
     chosen_types_text = ", ".join([types_text[t] for t in question_types if t in types_text])
 
+    # Phần riêng của batch (xem app/core/slice_planner.py): số câu đúng từng loại + sub-topic + bối cảnh
+    if type_counts:
+        distribution_text = "\n".join(
+            f"- Exactly {n} question(s) of type \"{t}\" ({types_text.get(t, t)})." for t, n in type_counts.items()
+        )
+    else:
+        distribution_text = "- You MUST generate a mix of the requested question types (unless only one type was requested)."
+    focus_lines = []
+    if sub_topics:
+        focus_lines.append(f"- Focus ONLY on these sub-topics of \"{topic}\": {', '.join(sub_topics)}.")
+    if context:
+        focus_lines.append(f"- Set the sentences in this context: {context}.")
+    if seed:
+        focus_lines.append(f"- Variation seed: {seed} (other batches of this test use other seeds; make these questions distinct).")
+    focus_text = ("\nBATCH FOCUS:\n" + "\n".join(focus_lines) + "\n") if focus_lines else ""
+
     return f"""
 You are an English teacher specialized in {exam_type}.
 Generate {num_questions} questions under the general theme "{topic}".
@@ -24,8 +50,8 @@ The required question types: {chosen_types_text}.
 Target exam level: {exam_type} {score_range}.
 
 IMPORTANT - DISTRIBUTION RULES:
-- You MUST generate a mix of the requested question types (unless only one type was requested).
-
+{distribution_text}
+{focus_text}
 Requirements for EACH question:
 - The **Question** and **Answers** must be in **English**.
 - Vocabulary and grammar must match the learner's {exam_type} {score_range} level.
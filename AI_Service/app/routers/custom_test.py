@@ -1,6 +1,8 @@
+from typing import Literal
 from fastapi import APIRouter
 from pydantic import BaseModel
-from app.services.render_custom import render_test
+from app.services.render_custom import render_test, render_test_stream
+from app.core.streaming import stream_events
 
 router = APIRouter(prefix="/generate-test-custom", tags=["Custom Test"])
 
@@ -14,7 +16,14 @@ class CustomRequest(BaseModel):
     question_ratio: str = "MCQ"
     num_questions: int = 15
     time_limit: int | None = 20
+    # Thời gian tối đa (giây) để sinh đủ câu, kể cả các vòng sinh bù; None = mặc định của server
+    deadline_s: float | None = None
 
 @router.post("/")
 async def generate_custom(req: CustomRequest):
     return await render_test(**req.dict())
+
+@router.post("/stream")
+async def generate_custom_stream(req: CustomRequest, format: Literal["ndjson", "sse"] = "ndjson"):
+    """Giống endpoint chính nhưng trả từng batch câu hỏi ngay khi sinh xong (NDJSON hoặc SSE)."""
+    return stream_events(render_test_stream(**req.dict()), format)
@@ -1,6 +1,8 @@
+from typing import Literal
 from fastapi import APIRouter
 from pydantic import BaseModel
-from app.services.render_topic import render_test
+from app.services.render_topic import render_test, render_test_stream
+from app.core.streaming import stream_events
 
 router = APIRouter(prefix="/generate-test", tags=["Test by Topic"])
 
@@ -10,7 +12,15 @@ class TestRequest(BaseModel):
     question_types: list = None
     exam_type: str = "TOEIC"
     score_range: str = None
+    question_ratio: dict[str, float] | None = None  # VD: {"multiple_choice": 70, "fill_in_blank": 30}
+    # Thời gian tối đa (giây) để sinh đủ câu, kể cả các vòng sinh bù; None = mặc định của server
+    deadline_s: float | None = None
 
 @router.post("/")
 async def generate_test(req: TestRequest):
     return await render_test(**req.dict())
+
+@router.post("/stream")
+async def generate_test_stream(req: TestRequest, format: Literal["ndjson", "sse"] = "ndjson"):
+    """Giống endpoint chính nhưng trả từng batch câu hỏi ngay khi sinh xong (NDJSON hoặc SSE)."""
+    return stream_events(render_test_stream(**req.dict()), format)
@@ -1,94 +1,263 @@
 # render_service.py
 
 import os
-import json
+import time
 import asyncio
+from contextlib import aclosing
 from dotenv import load_dotenv
 from google import genai
-from json_repair import repair_json
+from google.genai import types
 from app.prompts.prompt_custom import generate_test_prompt
+from app.core import gemini_scheduler
+from app.core.json_stream import QuestionStreamParser, parse_batch_text_async
+from app.core.schemas import QuestionBatch
+from app.core.singleflight import SingleFlight, make_key, reshuffle
+from app.core.hedging import Hedger
+from app.core.batch_planner import planner
+from app.core.dedup import NearDuplicateIndex, question_text, unique_questions
 
 load_dotenv(override=True)
 
 api_key = os.getenv("GEMINI_API_KEY")
 model_name = os.getenv("MODEL_NAME", "gemini-2.5-flash")
 client = genai.Client(api_key=api_key)
+# Structured output: Gemini trả JSON đúng schema QuestionBatch -> parse nhanh, hiếm khi cần repair
+generation_config = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=QuestionBatch,
+)
+# Ước lượng output token mỗi câu hỏi (để trừ ngân sách TPM của scheduler)
+OUTPUT_TOKENS_PER_QUESTION = 250
 
-# Hàm phụ để gọi 1 batch nhỏ
-async def generate_batch(batch_size: int, **kwargs):
+# Thời gian tối đa cho cả đề (giây) nếu request không truyền deadline_s, và số vòng sinh bù tối đa
+GENERATION_DEADLINE_S = float(os.getenv("GENERATION_DEADLINE_S", "60"))
+MAX_TOPUP_ROUNDS = int(os.getenv("MAX_TOPUP_ROUNDS", "3"))
+
+# Batch chậm bất thường được bắn thêm bản dự phòng (bật bằng HEDGE_ENABLED)
+hedger = Hedger("generate-test-custom")
+
+# Gộp các request giống hệt nhau đang chạy (VD: cả lớp mở cùng một link đề)
+inflight = SingleFlight("generate-test-custom")
+
+
+def question_type_of(params: dict) -> str:
+    """Loại câu hỏi dùng làm key thống kê cho batch planner."""
+    return (params.get("question_ratio") or "MCQ").strip().upper()
+
+
+# Hàm phụ stream 1 batch nhỏ: yield từng câu hỏi ngay khi JSON của nó hoàn chỉnh
+async def stream_batch(batch_size: int, **kwargs):
     """
-    Hàm này chịu trách nhiệm gọi AI và xử lý lỗi "tận gốc" cho từng batch.
-    Nếu lỗi, nó trả về danh sách rỗng [] chứ không throw Exception làm sập app.
+    Gọi Gemini ở chế độ stream và tách câu hỏi tăng dần bằng QuestionStreamParser.
+    Lỗi được log lại và kết thúc batch (không throw) để các batch khác vẫn chạy tiếp.
     """
     # 1. Cập nhật số lượng câu hỏi cho prompt này
     kwargs['num_questions'] = batch_size
     prompt = generate_test_prompt(**kwargs)
+    parser = QuestionStreamParser()
+    timing = {}  # scheduler ghi timing["started"] khi lấy được slot
+    output_tokens = None
 
     try:
-        # 2. Gọi AI (chạy trong thread pool để không chặn async loop)
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=model_name,
-            contents=prompt
+        # 2. Gọi AI qua scheduler chung (giới hạn đồng thời, RPM/TPM, retry 429/503)
+        chunks = gemini_scheduler.stream(
+            lambda: client.aio.models.generate_content_stream(
+                model=model_name, contents=prompt, config=generation_config
+            ),
+            est_tokens=gemini_scheduler.estimate_tokens(prompt, OUTPUT_TOKENS_PER_QUESTION * batch_size),
+            timing=timing,
         )
-        
-        raw_text = response.text.strip()
-
-        # 3. Xử lý chuỗi JSON (Phương pháp 3)
-        # repair_json sẽ tự động fix các lỗi cú pháp JSON phổ biến
-        cleaned_json_str = repair_json(raw_text)
-        data = json.loads(cleaned_json_str)
-
-        # 4. Chuẩn hóa dữ liệu đầu ra
-        # Đảm bảo kết quả luôn là một List câu hỏi
-        if isinstance(data, dict):
-            # Trường hợp AI trả về {"status": "success", "data": [...]}
-            return data.get("data", [])
-        elif isinstance(data, list):
-            # Trường hợp AI trả về thẳng [...]
-            return data
-        else:
-            return []
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                usage = getattr(chunk, "usage_metadata", None)
+                if usage and usage.candidates_token_count:
+                    output_tokens = usage.candidates_token_count
+                for question in await parser.afeed(chunk.text or ""):
+                    yield question
+
+        # Số liệu để planner chọn kích thước batch cho các lần sau
+        planner.record(question_type_of(kwargs), model_name, parser.emitted,
+                       time.monotonic() - timing["started"], output_tokens or len(parser.text) // 4)
+
+        # 3. Không tách được câu nào (output không đúng khuôn) -> parse cả batch
+        if parser.emitted == 0 and parser.text.strip():
+            for question in await parse_batch_text_async(parser.text):
+                yield question
 
     except Exception as e:
         # ✅ LOG LỖI NHƯNG KHÔNG CRASH
         print(f"⚠️ Batch error (size {batch_size}): {str(e)}")
-        # Trả về rỗng để các batch khác vẫn tiếp tục được ghép vào
-        return []
 
 
-# --- Hàm Chính: Điều phối song song ---
+# Hàm phụ để gọi 1 batch nhỏ
+async def generate_batch(batch_size: int, **kwargs):
+    """
+    Hàm này chịu trách nhiệm gọi AI và xử lý lỗi "tận gốc" cho từng batch.
+    Nếu lỗi, nó trả về các câu đã tách được (hoặc []) chứ không throw Exception làm sập app.
+    """
+    return [q async for q in stream_batch(batch_size, **kwargs)]
+
+
+def normalize_params(num_questions: int, **kwargs) -> dict:
+    """Chuẩn hóa tham số để các request tương đương cho ra cùng key."""
+    params = {"num_questions": num_questions}
+    for k, v in kwargs.items():
+        if isinstance(v, str):
+            v = " ".join(v.split()).lower()
+        elif isinstance(v, list):
+            v = sorted(" ".join(str(x).split()).lower() for x in v)
+        params[k] = v
+    return params
+
+
+# --- Hàm Chính ---
 async def render_test(
     num_questions: int = 15,
+    deadline_s: float | None = None,
     **kwargs # Nhận current_level, topics, etc.
 ):
-    BATCH_SIZE = 5 
-    
-    # 1. Chia nhỏ yêu cầu
-    batches = []
-    remaining = num_questions
-    while remaining > 0:
-        take = min(remaining, BATCH_SIZE)
-        batches.append(take)
-        remaining -= take
-
-    # 2. Tạo các task chạy song song (Concurrent)
+    """
+    Request trùng tham số với một request đang sinh dở sẽ chờ chung kết quả đó
+    thay vì gọi Gemini thêm lần nữa; mỗi follower nhận bản được xáo lại câu & đáp án.
+    """
+    key = make_key(normalize_params(num_questions, **kwargs))
+    result, is_leader = await inflight.do(key, lambda: generate_test(num_questions, deadline_s, **kwargs))
+    return result if is_leader else reshuffle(result)
+
+
+async def run_round(count: int, timeout: float, **kwargs) -> list:
+    """
+    Chạy song song các batch cho `count` câu, tối đa `timeout` giây.
+    Batch chưa xong khi hết giờ bị hủy; batch lỗi chỉ đóng góp [].
+    """
     # Lưu ý: truyền **kwargs để đẩy hết tham số (level, topic...) vào hàm con
-    tasks = [generate_batch(batch_size=b, **kwargs) for b in batches]
-    
-    # 3. Chạy tất cả và chờ kết quả
-    # return_exceptions=True giúp nếu 1 task chết hẳn cũng không ảnh hưởng task khác
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    # 4. Gộp kết quả
+    tasks = [asyncio.create_task(hedger.run(lambda b=b: generate_batch(batch_size=b, **kwargs)))
+             for b in planner.plan(count, question_type_of(kwargs), model_name)]
+    done, pending = await asyncio.wait(tasks, timeout=max(0.0, timeout))
+    for t in pending:
+        t.cancel()
+
+    questions = []
+    for t in done:
+        if not t.cancelled() and t.exception() is None:
+            questions.extend(t.result())
+    return questions
+
+
+# --- Điều phối song song + bù câu thiếu ---
+async def generate_test(
+    num_questions: int = 15,
+    deadline_s: float | None = None,
+    **kwargs
+):
+    """
+    Vòng 1 sinh đủ num_questions câu song song; các vòng sau chỉ sinh phần còn thiếu
+    (batch lỗi / bị cắt / câu gần trùng bị loại) cho tới khi đủ câu, hết MAX_TOPUP_ROUNDS hoặc hết deadline.
+    Trả về đúng num_questions câu nếu được; nếu không, kèm "shortfall" = số câu còn thiếu.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (deadline_s or GENERATION_DEADLINE_S)
+
     final_questions = []
-    for res in results:
-        if isinstance(res, list): # Chỉ gộp nếu kết quả là list hợp lệ
-            final_questions.extend(res)
-    
-    # 5. Kiểm tra kết quả cuối cùng
+    seen = NearDuplicateIndex()  # các batch song song dễ sinh câu gần giống nhau
+    rounds = 0
+    while len(final_questions) < num_questions and rounds <= MAX_TOPUP_ROUNDS:
+        remaining_s = deadline - loop.time()
+        if remaining_s <= 0:
+            break
+        missing = num_questions - len(final_questions)
+        if rounds:
+            print(f"🔁 Top-up lần {rounds}: còn thiếu {missing}/{num_questions} câu")
+        final_questions.extend(unique_questions(await run_round(missing, remaining_s, **kwargs), seen))
+        rounds += 1
+
+    final_questions = final_questions[:num_questions]
+
+    # Kiểm tra kết quả cuối cùng
     if not final_questions:
         # Nếu xui xẻo tất cả batch đều lỗi (rất hiếm)
         raise RuntimeError("AI service failed to generate any questions after retries.")
 
-    return {"status": "success", "data": final_questions}
\ No newline at end of file
+    result = {"status": "success", "data": final_questions}
+    shortfall = num_questions - len(final_questions)
+    if shortfall:
+        print(f"⚠️ Chỉ sinh được {len(final_questions)}/{num_questions} câu trước deadline")
+        result["shortfall"] = shortfall
+    return result
+
+
+# --- Phiên bản stream: trả từng câu hỏi ngay khi sinh xong ---
+async def render_test_stream(
+    num_questions: int = 15,
+    deadline_s: float | None = None,
+    **kwargs
+):
+    """
+    Async generator trả về các event (theo thứ tự sinh xong, không theo thứ tự batch):
+      {"event": "question", "batch": i, "index": k, "question": {...}}
+      {"event": "batch_done", "batch": i, "count": n}
+      {"event": "done", "total": n, "requested": num_questions, "shortfall": m}
+    "index" là vị trí slot cố định trong đề. Slot mà batch không lấp được sẽ được
+    các batch bù (top-up) lấp lại, trong giới hạn deadline.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (deadline_s or GENERATION_DEADLINE_S)
+    queue: asyncio.Queue = asyncio.Queue()
+    filled: set[int] = set()
+    tasks: list[asyncio.Task] = []
+    seen = NearDuplicateIndex()
+
+    async def run_batch(batch_no: int, slots: list[int]):
+        count = 0
+        try:
+            async with aclosing(stream_batch(batch_size=len(slots), **kwargs)) as questions:
+                async for question in questions:
+                    if count >= len(slots):
+                        break
+                    text = question_text(question)
+                    if not seen.add_if_new(text, text):
+                        continue  # câu gần trùng: slot để trống cho vòng bù
+                    queue.put_nowait({"event": "question", "batch": batch_no, "index": slots[count], "question": question})
+                    count += 1
+        finally:
+            queue.put_nowait({"event": "batch_done", "batch": batch_no, "count": count})
+
+    def launch(slots: list[int]):
+        # Chia các slot trống thành batch và chạy song song
+        sizes = planner.plan(len(slots), question_type_of(kwargs), model_name)
+        pos = 0
+        for size in sizes:
+            tasks.append(asyncio.create_task(run_batch(len(tasks), slots[pos:pos + size])))
+            pos += size
+        return len(sizes)
+
+    pending = launch(list(range(num_questions)))
+    rounds = 0
+    try:
+        while pending:
+            remaining_s = deadline - loop.time()
+            if remaining_s <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=remaining_s)
+            except asyncio.TimeoutError:
+                break
+            if event["event"] == "question":
+                filled.add(event["index"])
+            else:
+                pending -= 1
+            yield event
+
+            # Tất cả batch đã xong mà vẫn còn slot trống -> sinh bù đúng các slot đó
+            if not pending and len(filled) < num_questions and rounds < MAX_TOPUP_ROUNDS:
+                rounds += 1
+                free = [i for i in range(num_questions) if i not in filled]
+                print(f"🔁 Top-up lần {rounds}: còn thiếu {len(free)}/{num_questions} câu")
+                pending = launch(free)
+    finally:
+        # Client ngắt kết nối / hết deadline -> hủy các batch còn chạy
+        for t in tasks:
+            t.cancel()
+
+    yield {"event": "done", "total": len(filled), "requested": num_questions,
+           "shortfall": num_questions - len(filled)}
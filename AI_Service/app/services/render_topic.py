@@ -1,88 +1,368 @@
 import os
-import json
-import re
+import time
 import asyncio
+from contextlib import aclosing
 import random  # <--- 1. Thêm thư viện random
 from dotenv import load_dotenv
 from google import genai
-from app.prompts.prompt_topic import generate_test_prompt
+from google.genai import types
+from app.prompts.prompt_topic import generate_test_prompt, PROMPT_VERSION, DEFAULT_QUESTION_TYPES
+from app.core import gemini_scheduler
+from app.core.json_stream import QuestionStreamParser, parse_batch_text_async
+from app.core.schemas import QuestionBatch
+from app.core import test_cache
+from app.core.singleflight import SingleFlight, make_key, reshuffle
+from app.core.hedging import Hedger
+from app.core.batch_planner import planner
+from app.core.dedup import NearDuplicateIndex, question_text, unique_questions
+from app.core.slice_planner import split_topics, type_quota, plan_slices
 
 load_dotenv(override=True)
 
 api_key = os.getenv("GEMINI_API_KEY")
 model_name = os.getenv("MODEL_NAME", "gemini-1.5-flash")
 client = genai.Client(api_key=api_key)
+# Structured output: Gemini trả JSON đúng schema QuestionBatch -> parse nhanh, hiếm khi cần repair
+generation_config = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=QuestionBatch,
+)
+# Ước lượng output token mỗi câu hỏi (để trừ ngân sách TPM của scheduler)
+OUTPUT_TOKENS_PER_QUESTION = 250
+# Thời gian tối đa cho cả đề (giây) nếu request không truyền deadline_s, và số vòng sinh bù tối đa
+# khi thiếu câu (batch lỗi / câu gần trùng bị loại)
+GENERATION_DEADLINE_S = float(os.getenv("GENERATION_DEADLINE_S", "60"))
+MAX_TOPUP_ROUNDS = int(os.getenv("MAX_TOPUP_ROUNDS", "3"))
 
-# Hàm wrapper để gọi Gemini (vì hàm gốc có thể là sync blocking)
-async def call_gemini_async(prompt):
+# Batch chậm bất thường được bắn thêm bản dự phòng (bật bằng HEDGE_ENABLED)
+hedger = Hedger("generate-test")
+
+# Gộp các request giống hệt nhau đang chạy (cache chưa kịp có dữ liệu)
+inflight = SingleFlight("generate-test")
+
+# Stream 1 batch từ Gemini, yield từng câu hỏi ngay khi JSON của nó hoàn chỉnh
+async def stream_batch(prompt, expected_questions: int = 5, question_type: str = "mixed"):
+    parser = QuestionStreamParser()
+    timing = {}  # scheduler ghi timing["started"] khi lấy được slot
+    output_tokens = None
     try:
-        # Chạy hàm blocking trong thread pool để không chặn event loop
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model=model_name,
-            contents=prompt
+        # Gọi qua scheduler chung (giới hạn đồng thời, RPM/TPM, retry 429/503)
+        chunks = gemini_scheduler.stream(
+            lambda: client.aio.models.generate_content_stream(
+                model=model_name, contents=prompt, config=generation_config
+            ),
+            est_tokens=gemini_scheduler.estimate_tokens(prompt, OUTPUT_TOKENS_PER_QUESTION * expected_questions),
+            timing=timing,
         )
-        return response.text
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                usage = getattr(chunk, "usage_metadata", None)
+                if usage and usage.candidates_token_count:
+                    output_tokens = usage.candidates_token_count
+                for question in await parser.afeed(chunk.text or ""):
+                    yield question
+
+        # Số liệu để planner chọn kích thước batch cho các lần sau
+        planner.record(question_type, model_name, parser.emitted,
+                       time.monotonic() - timing["started"], output_tokens or len(parser.text) // 4)
     except Exception as e:
         print(f"Error in sub-request: {e}")
-        return ""
+
+    # Không tách được câu nào -> thử parse cả batch theo cách cũ
+    if parser.emitted == 0 and parser.text.strip():
+        for question in await parse_batch_text_async(parser.text):
+            yield question
+
+
+# Gọi 1 batch và gom toàn bộ câu hỏi
+async def generate_batch(prompt, expected_questions: int = 5, question_type: str = "mixed") -> list:
+    return [q async for q in stream_batch(prompt, expected_questions, question_type)]
+
+def question_type_key(question_types: list) -> str:
+    """Loại câu hỏi dùng làm key thống kê cho batch planner."""
+    return ",".join(sorted(question_types)) if question_types else "mixed"
+
+
+def shuffle_options(questions: list):
+    """Xáo trộn đáp án để vị trí đáp án đúng không cố định."""
+    for question in questions:
+        # Kiểm tra nếu có options và là list không rỗng
+        if "options" in question and isinstance(question["options"], list) and len(question["options"]) > 0:
+            random.shuffle(question["options"])
+
+
+def cache_key(topic: str, question_types: list, exam_type: str, score_range: str) -> str:
+    """Key cache từ tham số đã chuẩn hóa (không gồm num_questions: pool dùng chung cho mọi độ dài đề)."""
+    params = {
+        "topic": " ".join((topic or "").lower().split()),
+        "question_types": sorted(question_types) if question_types else None,
+        "exam_type": (exam_type or "").strip().upper(),
+        "score_range": " ".join((score_range or "").split()) or None,
+    }
+    return test_cache.make_key(params, PROMPT_VERSION)
+
+
+async def cache_lookup(key: str, num_questions: int, counts: dict | None = None) -> list | None:
+    """
+    Trả về num_questions câu lấy từ cache (đã xáo), None nếu cache chưa đủ câu.
+    Có `counts` (số câu mỗi loại) thì lấy đúng số câu từng loại từ pool.
+    """
+    cache = test_cache.get_cache()
+    if cache is None:
+        return None
+    pool = await asyncio.to_thread(cache.get, key)
+    if not pool or len(pool) < num_questions:
+        return None
+    if not counts:
+        return test_cache.fresh_sample(pool, num_questions)
+
+    picked = []
+    for qtype, n in counts.items():
+        candidates = [q for q in pool if type_label(q) == qtype]
+        if len(candidates) < n:
+            return None
+        picked += test_cache.fresh_sample(candidates, n)
+    random.shuffle(picked)
+    return picked
+
+
+def type_label(question: dict) -> str:
+    """Chuẩn hóa nhãn loại câu hỏi: "Multiple-choice" / "multiple choice" => "multiple_choice"."""
+    return "_".join(str(question.get("type", "")).lower().replace("-", " ").split())
+
+
+def take_quota(quota: dict, question: dict) -> bool:
+    """Trừ một câu khỏi hạn mức loại của nó; False nếu loại đó đã đủ (hoặc không có trong đề)."""
+    label = type_label(question)
+    if quota.get(label, 0) > 0:
+        quota[label] -= 1
+        return True
+    return False
+
+
+def type_counts_for(num_questions: int, question_types: list, question_ratio: dict | None) -> dict:
+    """Số câu mỗi loại của cả đề (theo question_ratio, mặc định chia đều các loại được chọn)."""
+    return type_quota(num_questions, question_types or DEFAULT_QUESTION_TYPES, question_ratio)
+
+
+def batch_slices(key: str, topic: str, counts: dict, qtype: str, round_no: int = 0) -> list:
+    """
+    Chia `counts` thành các batch (kích thước do planner chọn), mỗi batch một phần riêng:
+    sub-topic, số câu từng loại, bối cảnh và seed khác nhau => các batch không sinh câu chồng lặp.
+    """
+    sizes = planner.plan(sum(counts.values()), qtype, model_name)
+    sub_topics = split_topics(topic)
+    # Chỉ một chủ đề thì không có gì để chia; các batch khác nhau nhờ bối cảnh + seed
+    return plan_slices(sizes, sub_topics if len(sub_topics) > 1 else [], counts, f"{key}:{round_no}")
+
+
+def slice_prompt(topic: str, question_types: list, exam_type: str, score_range: str, part: dict) -> str:
+    return generate_test_prompt(
+        topic=topic,
+        question_types=question_types,
+        num_questions=part["size"],
+        exam_type=exam_type,
+        score_range=score_range,
+        sub_topics=part["sub_topics"],
+        type_counts=part["type_counts"],
+        context=part["context"],
+        seed=part["seed"],
+    )
+
+
+async def cache_store(key: str, questions: list):
+    cache = test_cache.get_cache()
+    if cache is not None and questions:
+        try:
+            await asyncio.to_thread(cache.add, key, questions)
+        except Exception as e:
+            print(f"⚠️ Không ghi được cache đề: {e}")
+
 
 async def render_test(topic: str,
                       num_questions: int = 10,
                       question_types: list = None,
                       exam_type: str = "TOEIC",
-                      score_range: str = None):
-    
-    # CHIẾN THUẬT: CHIA NHỎ REQUEST
-    batch_size = 5
-    tasks = []
+                      score_range: str = None,
+                      question_ratio: dict = None,
+                      deadline_s: float | None = None):
     
-    remaining = num_questions
-    while remaining > 0:
-        current_batch = min(remaining, batch_size)
-        
-        prompt = generate_test_prompt(
-            topic=topic,
-            question_types=question_types,
-            num_questions=current_batch,
-            exam_type=exam_type,
-            score_range=score_range
-        )
-        
-        tasks.append(call_gemini_async(prompt))
-        remaining -= current_batch
+    # 0. Đề giống hệt đã sinh trước đó -> lấy từ cache (xáo lại câu & đáp án)
+    key = cache_key(topic, question_types, exam_type, score_range)
+    counts = type_counts_for(num_questions, question_types, question_ratio)
+    cached = await cache_lookup(key, num_questions, counts)
+    if cached is not None:
+        return {"status": "success", "data": cached}
 
-    # CHẠY TẤT CẢ CÁC REQUEST CÙNG LÚC
-    results = await asyncio.gather(*tasks)
-    
-    # GỘP KẾT QUẢ
+    # 1. Request giống hệt đang sinh dở -> chờ chung, nhận bản xáo lại
+    result, is_leader = await inflight.do(
+        f"{key}:{make_key(counts)}",
+        lambda: generate_test(key, topic, counts, question_types, exam_type, score_range, deadline_s)
+    )
+    return result if is_leader else reshuffle(result)
+
+
+async def generate_test(key: str,
+                        topic: str,
+                        counts: dict,
+                        question_types: list,
+                        exam_type: str,
+                        score_range: str,
+                        deadline_s: float | None = None):
+    """
+    Vòng 1 sinh cả đề song song; các vòng sau chỉ sinh bù đúng loại còn thiếu, cho tới khi đủ câu,
+    hết MAX_TOPUP_ROUNDS hoặc hết deadline. Không đủ câu thì kèm "shortfall" = số câu còn thiếu.
+    """
+    # CHIẾN THUẬT: CHIA NHỎ REQUEST - mỗi batch một phần riêng (sub-topic, số câu từng loại, bối cảnh, seed)
+    qtype = question_type_key(question_types)
+    num_questions = sum(counts.values())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (deadline_s or GENERATION_DEADLINE_S)
+
+    async def run_round(round_counts: dict, round_no: int, timeout: float) -> list:
+        tasks = []
+        for part in batch_slices(key, topic, round_counts, qtype, round_no):
+            prompt = slice_prompt(topic, question_types, exam_type, score_range, part)
+            tasks.append(asyncio.create_task(hedger.run(lambda p=prompt, n=part["size"]: generate_batch(p, n, qtype))))
+        # CHẠY TẤT CẢ CÁC REQUEST CÙNG LÚC; batch chưa xong khi hết giờ bị hủy
+        done, pending = await asyncio.wait(tasks, timeout=max(0.0, timeout))
+        for t in pending:
+            t.cancel()
+        return [q for t in done if not t.cancelled() and t.exception() is None for q in t.result()]
+
+    # GỘP KẾT QUẢ theo hạn mức từng loại, loại câu gần trùng; thiếu thì chỉ sinh bù đúng loại còn thiếu
     final_data = []
-    
-    for text in results:
-        text = text.strip()
-        # Clean text logic
-        clean_text = re.sub(r"^```(?:json)?|```$", "", text, flags=re.MULTILINE).strip()
+    spare = []  # câu dư của loại đã đủ: chỉ dùng nếu hết vòng bù mà vẫn thiếu
+    quota = dict(counts)
+    seen = NearDuplicateIndex()
+    rounds = 0
+    while sum(quota.values()) > 0 and rounds <= MAX_TOPUP_ROUNDS:
+        remaining_s = deadline - loop.time()
+        if remaining_s <= 0:
+            break
+        if rounds:
+            print(f"🔁 Top-up lần {rounds}: còn thiếu {quota}")
+        round_counts = {t: n for t, n in quota.items() if n > 0}
+        for question in unique_questions(await run_round(round_counts, rounds, remaining_s), seen):
+            if take_quota(quota, question):
+                final_data.append(question)
+            else:
+                spare.append(question)
+        rounds += 1
+        # Đủ số câu nhưng sai nhãn loại (Gemini không theo đúng tỉ lệ) -> lấp bằng câu dư, không gọi thêm
+        if len(spare) >= sum(quota.values()):
+            break
+    final_data = (final_data + spare)[:num_questions]
+
+    await cache_store(key, final_data)
+
+    # XÁO TRỘN ĐÁP ÁN (Trước khi return)
+    shuffle_options(final_data)
+
+    result = {"status": "success", "data": final_data}
+    shortfall = num_questions - len(final_data)
+    if shortfall:
+        print(f"⚠️ Chỉ sinh được {len(final_data)}/{num_questions} câu (hết vòng bù / deadline)")
+        result["shortfall"] = shortfall
+    return result
+
+
+# --- Phiên bản stream: trả từng câu hỏi ngay khi sinh xong ---
+async def render_test_stream(topic: str,
+                             num_questions: int = 10,
+                             question_types: list = None,
+                             exam_type: str = "TOEIC",
+                             score_range: str = None,
+                             question_ratio: dict = None,
+                             deadline_s: float | None = None):
+    """
+    Async generator trả về các event (theo thứ tự sinh xong, không theo thứ tự batch):
+      {"event": "question", "batch": i, "index": k, "question": {...}}
+      {"event": "batch_done", "batch": i, "count": n}
+      {"event": "done", "total": n, "requested": num_questions, "shortfall": m}
+    "index" là vị trí slot cố định trong đề, không phụ thuộc thứ tự hoàn thành. Slot bị bỏ trống
+    (batch lỗi / câu gần trùng bị loại) được các batch bù lấp lại, trong giới hạn deadline.
+    """
+    key = cache_key(topic, question_types, exam_type, score_range)
+    counts = type_counts_for(num_questions, question_types, question_ratio)
+    cached = await cache_lookup(key, num_questions, counts)
+    if cached is not None:
+        for i, question in enumerate(cached):
+            yield {"event": "question", "batch": 0, "index": i, "question": question}
+        yield {"event": "batch_done", "batch": 0, "count": len(cached)}
+        yield {"event": "done", "total": len(cached), "requested": num_questions, "cached": True, "shortfall": 0}
+        return
+
+    qtype = question_type_key(question_types)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (deadline_s or GENERATION_DEADLINE_S)
+    queue: asyncio.Queue = asyncio.Queue()
+    generated = []
+    filled: set[int] = set()
+    quota = dict(counts)  # số câu mỗi loại còn thiếu (theo câu đã gửi đi)
+    tasks: list[asyncio.Task] = []
+    seen = NearDuplicateIndex()
+
+    async def run_batch(batch_no: int, slots: list[int], part: dict):
+        prompt = slice_prompt(topic, question_types, exam_type, score_range, part)
+        count = 0
         try:
-            # Cố gắng parse JSON
+            async with aclosing(stream_batch(prompt, len(slots), qtype)) as questions:
+                async for question in questions:
+                    if count >= len(slots):
+                        break
+                    text = question_text(question)
+                    if not seen.add_if_new(text, text):
+                        continue  # câu gần trùng: slot để trống cho vòng bù
+                    shuffle_options([question])
+                    queue.put_nowait({"event": "question", "batch": batch_no, "index": slots[count], "question": question})
+                    count += 1
+        finally:
+            queue.put_nowait({"event": "batch_done", "batch": batch_no, "count": count})
+
+    def launch(slots: list[int], round_counts: dict, round_no: int) -> int:
+        # Chia các slot trống thành batch (mỗi batch một phần riêng của đề) và chạy song song
+        parts = batch_slices(key, topic, round_counts, qtype, round_no)
+        pos = 0
+        for part in parts:
+            tasks.append(asyncio.create_task(run_batch(len(tasks), slots[pos:pos + part["size"]], part)))
+            pos += part["size"]
+        return len(parts)
+
+    pending = launch(list(range(num_questions)), counts, 0)
+    rounds = 0
+    try:
+        while pending:
+            remaining_s = deadline - loop.time()
+            if remaining_s <= 0:
+                break
             try:
-                data_batch = json.loads(clean_text)
-            except:
-                # Fallback fix lỗi JSON
-                fixed_text = clean_text.replace('\n', '\\n')
-                data_batch = json.loads(fixed_text)
-                
-            if isinstance(data_batch, dict) and "data" in data_batch:
-                final_data.extend(data_batch["data"])
-        except Exception as e:
-            print(f"Bỏ qua một batch do lỗi parse: {e}")
-            continue
+                event = await asyncio.wait_for(queue.get(), timeout=remaining_s)
+            except asyncio.TimeoutError:
+                break
+            if event["event"] == "question":
+                filled.add(event["index"])
+                generated.append(event["question"])
+                take_quota(quota, event["question"])
+            else:
+                pending -= 1
+            yield event
 
-    # ---------------------------------------------------------
-    # 2. THÊM LOGIC XÁO TRỘN ĐÁP ÁN Ở ĐÂY (Trước khi return)
-    # ---------------------------------------------------------
-    for question in final_data:
-        # Kiểm tra nếu có options và là list không rỗng
-        if "options" in question and isinstance(question["options"], list) and len(question["options"]) > 0:
-            random.shuffle(question["options"]) 
+            # Tất cả batch đã xong mà vẫn còn slot trống -> sinh bù đúng các slot đó (ưu tiên loại còn thiếu)
+            if not pending and len(filled) < num_questions and rounds < MAX_TOPUP_ROUNDS:
+                rounds += 1
+                free = [i for i in range(num_questions) if i not in filled]
+                round_counts = {t: n for t, n in quota.items() if n > 0}
+                if sum(round_counts.values()) != len(free):
+                    # Câu bị Gemini gắn sai loại đã chiếm slot => chia lại số slot trống theo tỉ lệ đề
+                    round_counts = type_quota(len(free), list(counts), counts)
+                print(f"🔁 Top-up lần {rounds}: còn thiếu {len(free)}/{num_questions} câu")
+                pending = launch(free, round_counts, rounds)
+    finally:
+        # Client ngắt kết nối / hết deadline -> hủy các batch còn chạy
+        for t in tasks:
+            t.cancel()
 
-    return {"status": "success", "data": final_data}
\ No newline at end of file
+    await cache_store(key, generated)
+    yield {"event": "done", "total": len(filled), "requested": num_questions,
+           "shortfall": num_questions - len(filled)}
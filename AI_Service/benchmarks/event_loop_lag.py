@@ -0,0 +1,80 @@
+"""
+Đo độ trễ event loop khi nhiều batch output hỏng cùng phải repair.
+
+Chạy từ thư mục AI_Service:
+    python -m benchmarks.event_loop_lag --batches 20 --questions 40
+
+So sánh hai chế độ: repair inline trên event loop và offload sang process pool (cpu_pool).
+Số liệu in ra là độ trễ của một ticker 10ms chạy song song: lag càng lớn thì các request
+khác (stream, health check) càng bị chặn lâu.
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+from app.core import cpu_pool
+from app.core.json_stream import parse_batch_text_async
+
+TICK_S = 0.01
+
+
+def broken_batch(n_questions: int, seed: int) -> str:
+    """Output giống Gemini nhưng hỏng cú pháp: thiếu dấu phẩy giữa các object, dư dấu phẩy cuối mảng."""
+    items = []
+    for i in range(n_questions):
+        items.append(
+            '{"type": "multiple_choice", "skill": "grammar", "topic": ["tenses"], '
+            f'"question": "Batch {seed} question {i}: She ___ to school every day.", '
+            '"options": ["A. go", "B. goes", "C. going", "D. gone",], '
+            '"answer": "B", "explanation": "Chủ ngữ số ít dùng động từ thêm -s"}'
+        )
+    return '```json\n{"status": "success", "data": [' + "\n".join(items) + "]}\n```"
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK_S)
+        lags.append((time.perf_counter() - started - TICK_S) * 1000)
+
+
+async def run_mode(texts: list, offload: bool) -> dict:
+    cpu_pool.CPU_OFFLOAD_THRESHOLD = 0 if offload else 10 ** 12
+    if offload:
+        # Khởi động worker trước để không tính chi phí spawn process vào số liệu
+        await parse_batch_text_async(texts[0])
+
+    lags: list = []
+    stop = asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(parse_batch_text_async(t) for t in texts))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+
+    lags.sort()
+    return {
+        "mode": "offload" if offload else "inline",
+        "questions": sum(len(r) for r in results),
+        "wall_s": round(elapsed, 2),
+        "lag_p50_ms": round(statistics.median(lags), 1) if lags else None,
+        "lag_p99_ms": round(lags[int(0.99 * (len(lags) - 1))], 1) if lags else None,
+        "lag_max_ms": round(lags[-1], 1) if lags else None,
+    }
+
+
+async def main(batches: int, questions: int):
+    texts = [broken_batch(questions, i) for i in range(batches)]
+    for offload in (False, True):
+        print(await run_mode(texts, offload))
+    cpu_pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=40)
+    args = parser.parse_args()
+    asyncio.run(main(args.batches, args.questions))
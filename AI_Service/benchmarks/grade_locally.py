@@ -0,0 +1,58 @@
+"""
+Đo thời gian chấm một bài với answer key 200 / 1.000 / 10.000 câu.
+
+Chạy từ thư mục AI_Service:
+    python -m benchmarks.grade_locally
+
+Các chế độ:
+  full         grade_locally(answer_key, answers): chuẩn hóa đáp án + giải thích từng câu (như endpoint /grade/)
+  cached_key   dùng NormalizedKey tạo sẵn cho đề (bỏ bước chuẩn hóa đáp án)
+  no_explain   NormalizedKey + không sinh câu giải thích
+"""
+import time
+import random
+import argparse
+
+from app.core.schemas import QuestionKey
+from app.core.grader import NormalizedKey, grade_locally, grade_normalized
+
+SKILLS = ["Grammar", "Vocabulary", "Reading", "Listening"]
+TOPICS = ["Tenses", "Passive", "Conditionals", "Business", "Travel", None]
+
+
+def make_case(n_questions: int, seed: int = 0):
+    rng = random.Random(seed)
+    answer_key = [
+        QuestionKey(id=i, question=f"Question {i}", answer=rng.choice("ABCD"),
+                    skill=rng.choice(SKILLS), topic=rng.choice(TOPICS))
+        for i in range(n_questions)
+    ]
+    answers = {str(i): rng.choice("ABCDabcd ") for i in range(n_questions) if rng.random() < 0.95}
+    return answer_key, answers
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main(sizes, repeat: int):
+    for n in sizes:
+        answer_key, answers = make_case(n)
+        key = NormalizedKey(answer_key)
+        full = best_of(lambda: grade_locally(answer_key, answers), repeat)
+        cached = best_of(lambda: grade_normalized(key, answers), repeat)
+        no_explain = best_of(lambda: grade_normalized(key, answers, explain=False), repeat)
+        print(f"{n:>6} câu | full {full:8.2f} ms | cached_key {cached:8.2f} ms | no_explain {no_explain:8.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.sizes, args.repeat)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Chạy pytest từ thư mục AI_Service hoặc từ gốc repo đều import được package `app`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Các service tạo genai.Client lúc import; test không gọi Gemini nên key giả là đủ
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
@@ -0,0 +1,34 @@
+import random
+
+from app.core.batch_grader import grade_batch
+from app.core.grader import grade_locally
+from app.core.schemas import QuestionKey
+
+SKILLS = ["Grammar", "Vocabulary", None]
+TOPICS = ["Tenses", "Passive", "Business", "Travel", None]
+
+
+def random_case(rng: random.Random, n_sheets: int = 5):
+    answer_key = [
+        QuestionKey(id=i, question=f"Q{i}", answer=rng.choice("ABCD"),
+                    skill=rng.choice(SKILLS), topic=rng.choice(TOPICS))
+        for i in range(rng.randint(1, 30))
+    ]
+    sheets = [
+        {str(q.id): rng.choice(["A", "b ", "C", "d", ""]) for q in answer_key if rng.random() < 0.9}
+        for _ in range(n_sheets)
+    ]
+    return answer_key, sheets
+
+
+def test_batch_matches_grade_locally():
+    rng = random.Random(7)
+    for _ in range(300):
+        answer_key, sheets = random_case(rng)
+        batch = grade_batch(answer_key, [f"s{i}" for i in range(len(sheets))], sheets)
+        for result, answers in zip(batch["results"], sheets):
+            total_correct, total_qs, _, skill_summary, weak_topics = grade_locally(answer_key, answers)
+            assert result["total_score"] == total_correct
+            assert result["total_questions"] == total_qs
+            assert result["skill_summary"] == [s.model_dump() for s in skill_summary]
+            assert result["weak_topics"] == weak_topics
@@ -0,0 +1,47 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from app.core import batch_planner, gemini_scheduler
+from app.services import render_topic
+
+QUESTION = {"type": "multiple_choice", "skill": "Grammar", "topic": ["Tenses"], "question": "She ___ here.",
+            "options": ["A. is", "B. are"], "answer": "A", "explanation": "Singular subject."}
+
+
+def fake_client(n_questions):
+    async def generate_content_stream(**kwargs):
+        async def chunks():
+            text = json.dumps({"status": "ok", "data": [QUESTION] * n_questions})
+            yield SimpleNamespace(text=text, usage_metadata=None)
+        return chunks()
+    return SimpleNamespace(aio=SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream)))
+
+
+async def run_batch(queue_wait_s):
+    async def hold_slot():
+        async with gemini_scheduler.slot():
+            await asyncio.sleep(queue_wait_s)
+
+    holder = asyncio.create_task(hold_slot())
+    await asyncio.sleep(0)  # để holder lấy slot trước
+    questions = [q async for q in render_topic.stream_batch("prompt", 5, "MCQ")]
+    await holder
+    return len(questions)
+
+
+def test_queue_wait_does_not_change_batch_size(monkeypatch):
+    # Mục tiêu 0.5s / lời gọi: nếu tính cả 0.5s chờ slot thì 5 câu "mất" 0.1s / câu => batch 5 thay vì 10
+    monkeypatch.setattr(batch_planner, "TARGET_BATCH_LATENCY_S", 0.5)
+    monkeypatch.setattr(batch_planner, "PER_CALL_OVERHEAD_S", 0.0)
+    monkeypatch.setattr(render_topic, "client", fake_client(5))
+
+    sizes = []
+    for queue_wait_s in (0.0, 0.5):
+        # Mỗi asyncio.run là một event loop mới => semaphore 1 slot mới
+        monkeypatch.setattr(gemini_scheduler, "_semaphore", asyncio.Semaphore(1))
+        monkeypatch.setattr(render_topic, "planner", batch_planner.BatchPlanner())
+        assert asyncio.run(run_batch(queue_wait_s)) == 5
+        sizes.append(render_topic.planner.batch_size("MCQ", render_topic.model_name))
+
+    assert sizes[0] == sizes[1] == 10
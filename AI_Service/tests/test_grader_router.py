@@ -0,0 +1,62 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routers import grader_router
+from app.core import profile_store
+from app.core.answer_keys import registry as answer_keys
+
+ANSWER_KEY = [
+    {"id": i, "question": f"Question {i}", "answer": "ABCD"[i % 4],
+     "skill": "Grammar" if i % 2 else "Vocabulary", "topic": f"Topic {i % 3}"}
+    for i in range(12)
+]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(profile_store, "_store", profile_store.ProfileStore(path=str(tmp_path / "profiles.sqlite3")))
+    app = FastAPI()
+    app.include_router(grader_router.router)
+    yield TestClient(app)
+    profile_store.close_store()
+    answer_keys.remove("batch-test")
+
+
+def test_batch_with_inline_answer_key(client):
+    resp = client.post("/grade/batch", json={
+        "answer_key": ANSWER_KEY,
+        "submissions": [
+            {"student_id": "s1", "student_answers": {str(i): "A" for i in range(12)}},
+            {"student_id": "s2", "student_answers": {str(q["id"]): q["answer"] for q in ANSWER_KEY}},
+        ],
+    })
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["total_students"] == 2
+    assert [r["total_score"] for r in body["results"]] == [3, 12]
+
+
+def test_batch_with_registered_test_id(client):
+    assert client.post("/grade/keys", json={"test_id": "batch-test", "answer_key": ANSWER_KEY}).status_code == 200
+    sheets = [{"student_id": "s1", "student_answers": {"0": "a", "1": "B"}}]
+    by_id = client.post("/grade/batch", json={"test_id": "batch-test", "submissions": sheets})
+    inline = client.post("/grade/batch", json={"answer_key": ANSWER_KEY, "submissions": sheets})
+    assert by_id.status_code == 200
+    assert by_id.json() == inline.json()
+
+
+def test_batch_unknown_test_id_is_404(client):
+    resp = client.post("/grade/batch", json={"test_id": "missing", "submissions": []})
+    assert resp.status_code == 404
+
+
+def test_grade_appends_attempt_to_stored_profile(client):
+    assert client.post("/grade/keys", json={"test_id": "batch-test", "answer_key": ANSWER_KEY}).status_code == 200
+    body = {"test_id": "batch-test", "student_id": "s1", "student_answers": {"0": "A"}}
+    first = client.post("/grade/", json=body).json()
+    second = client.post("/grade/", json=body).json()
+    assert [first["trend_state"]["count"], second["trend_state"]["count"]] == [1, 2]
+    stored = client.get("/grade/profiles/s1").json()
+    assert len(stored["test_history"]) == 2
+    assert stored["trend_state"] == second["trend_state"]
@@ -0,0 +1,25 @@
+import asyncio
+
+from app.core.json_stream import QuestionStreamParser
+
+VALID = ('{"type": "multiple_choice", "skill": "Grammar", "topic": ["Tenses"], "question": "She ___ here.",'
+         ' "options": ["A. is", "B. are"], "answer": "A", "explanation": "Singular subject."}')
+INVALID = '{"question": "missing fields"}'
+
+
+def test_emitted_counts_only_valid_questions():
+    parser = QuestionStreamParser()
+    text = '{"status": "ok", "data": [' + INVALID + ", " + VALID + "]}"
+    questions = [q for i in range(0, len(text), 7) for q in parser.feed(text[i:i + 7])]
+    assert len(questions) == 1
+    assert parser.emitted == 1
+
+
+def test_emitted_stays_zero_when_all_invalid_async():
+    parser = QuestionStreamParser()
+
+    async def run():
+        return await parser.afeed("[" + INVALID + ", " + INVALID + "]")
+
+    assert asyncio.run(run()) == []
+    assert parser.emitted == 0
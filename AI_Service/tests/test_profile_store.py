@@ -0,0 +1,57 @@
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.profile_store import ProfileStore, attempt_summary
+from app.core.schemas import TrendState
+
+
+def test_concurrent_attempts_all_counted(tmp_path):
+    store = ProfileStore(path=str(tmp_path / "profiles.sqlite3"))
+    scores = [float(i % 7 * 10) for i in range(40)]
+
+    def submit(score):
+        return store.append_attempt("s1", attempt_summary({"score_percentage": score}), score)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(submit, scores))
+
+    trend = TrendState(**store.get("s1")["trend_state"])
+    assert trend.count == len(scores) == store.get_stats()["attempts"]
+    assert abs(trend.mean - statistics.mean(scores)) < 1e-9
+    assert abs(trend.m2 / (trend.count - 1) - statistics.variance(scores)) < 1e-9
+    store.close()
+
+
+def test_prior_only_seeds_new_trend(tmp_path):
+    store = ProfileStore(path=str(tmp_path / "profiles.sqlite3"))
+    prior = TrendState(count=1, first_score=50.0, last_score=50.0, mean=50.0, recent_scores=[50.0])
+    assert store.append_attempt("s1", attempt_summary({}), 70.0, prior).count == 2
+    # Kho đã có trend => prior (có thể đã cũ) bị bỏ qua
+    assert store.append_attempt("s1", attempt_summary({}), 90.0, prior).count == 3
+    store.close()
+
+
+def test_two_workers_share_trend_state(tmp_path):
+    # Hai ProfileStore trên cùng file = hai worker uvicorn: LRU riêng, trend_state chung trong SQLite
+    path = str(tmp_path / "profiles.sqlite3")
+    workers = [ProfileStore(path=path), ProfileStore(path=path)]
+    scores = [float(i * 3 % 100) for i in range(60)]
+
+    def submit(i):
+        score = scores[i]
+        return workers[i % 2].append_attempt("s1", attempt_summary({"score_percentage": score}), score)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(submit, range(len(scores))))
+
+    for store in workers:
+        stored = store.get("s1")
+        trend = TrendState(**stored["trend_state"])
+        assert trend.count == len(scores)
+        assert abs(trend.mean - statistics.mean(scores)) < 1e-9
+        assert len(stored["test_history"]) == store.history_limit
+    # Worker 0 đã cache hồ sơ; worker 1 ghi thêm => worker 0 đọc thấy bản mới
+    workers[1].append_attempt("s1", attempt_summary({"score_percentage": 100.0}), 100.0)
+    assert workers[0].get("s1")["trend_state"]["count"] == len(scores) + 1
+    for store in workers:
+        store.close()
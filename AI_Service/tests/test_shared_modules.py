@@ -0,0 +1,35 @@
+import re
+from pathlib import Path
+
+import pytest
+
+# Các module được chép nguyên văn sang service khác (mỗi service deploy riêng nên không import chéo được):
+# chỉ được khác nhau ở đường dẫn import; sửa một bản thì phải sửa mọi bản.
+ROOT = Path(__file__).resolve().parents[2]
+SHARED_MODULES = {
+    "gemini_scheduler.py": ["AI_Grader_Service/app", "AI_Generate_Testing_Custom/app"],
+    "batch_planner.py": ["AI_Generate_Testing_Custom/app"],
+    "dedup.py": ["AI_Generate_Testing_Custom/app"],
+    "grader.py": ["AI_Grader_Service/app"],
+    "material_mapper.py": ["AI_Grader_Service/app"],
+    "profile_store.py": ["AI_Grader_Service/app"],
+    "trend.py": ["AI_Grader_Service/app"],
+}
+# "from app.core import x" / "from app import x" / "from . import x" và
+# "from app.core.schemas import" / "from app.schemas import" / "from .schemas import" => cùng một dạng
+PACKAGE_IMPORT = re.compile(r"^from (?:app\.core|app|\.) import", re.MULTILINE)
+MODULE_IMPORT = re.compile(r"^from (?:app\.core\.|app\.|\.)(\w+) import", re.MULTILINE)
+
+
+def normalized(path: Path) -> str:
+    text = PACKAGE_IMPORT.sub("from . import", path.read_text(encoding="utf-8"))
+    return MODULE_IMPORT.sub(r"from .\1 import", text)
+
+
+@pytest.mark.parametrize("name,copy_dir", [(name, d) for name, dirs in SHARED_MODULES.items() for d in dirs])
+def test_shared_module_copies_stay_in_sync(name, copy_dir):
+    source = ROOT / "AI_Service/app/core" / name
+    copy = ROOT / copy_dir / name
+    assert normalized(copy) == normalized(source), (
+        f"{copy_dir}/{name} lệch với AI_Service/app/core/{name}: sửa một bản thì chép sang mọi bản"
+    )
@@ -0,0 +1,23 @@
+from app.core.slice_planner import plan_slices, type_quota
+
+
+def test_rounds_get_different_seeds():
+    counts = type_quota(10, ["multiple_choice", "fill_in_blank"])
+    key = "a" * 64  # cache key thật là sha256 hex; 8 ký tự đầu giống nhau giữa các vòng
+    round0 = plan_slices([5, 5], [], counts, f"{key}:0")
+    round1 = plan_slices([5, 5], [], counts, f"{key}:1")
+    seeds0 = {part["seed"] for part in round0}
+    seeds1 = {part["seed"] for part in round1}
+    assert len(seeds0) == 2 and len(seeds1) == 2
+    assert not seeds0 & seeds1
+
+
+def test_slices_cover_type_counts():
+    counts = {"multiple_choice": 7, "fill_in_blank": 3}
+    parts = plan_slices([4, 3, 3], ["Tenses", "Passive"], counts, "seed:0")
+    total = {}
+    for part in parts:
+        for t, n in part["type_counts"].items():
+            total[t] = total.get(t, 0) + n
+    assert total == counts
+    assert [p["size"] for p in parts] == [4, 3, 3]
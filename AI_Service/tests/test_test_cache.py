@@ -0,0 +1,33 @@
+from app.core import test_cache
+
+
+def questions(*names):
+    return [{"question": n, "options": ["A", "B"], "answer": "A"} for n in names]
+
+
+def test_refresh_extends_ttl_then_expires(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(test_cache.time, "time", lambda: now[0])
+    cache = test_cache.TestCache(path=str(tmp_path / "cache.sqlite3"), ttl=100)
+
+    cache.add("k", questions("q1", "q2"))
+    now[0] += 80
+    cache.add("k", questions("q3"))  # làm mới pool trước khi hết hạn
+    now[0] += 80                     # quá TTL tính từ lần tạo đầu, chưa quá TTL từ lần làm mới
+    pool = cache.get("k")
+    assert [q["question"] for q in pool] == ["q1", "q2", "q3"]
+
+    now[0] += 30                     # quá TTL tính từ lần làm mới cuối
+    assert cache.get("k") is None
+
+
+def test_adding_only_known_questions_does_not_extend_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(test_cache.time, "time", lambda: now[0])
+    cache = test_cache.TestCache(path=str(tmp_path / "cache.sqlite3"), ttl=100)
+
+    cache.add("k", questions("q1"))
+    now[0] += 80
+    cache.add("k", questions("q1"))
+    now[0] += 30
+    assert cache.get("k") is None
@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 from dotenv import load_dotenv
 from google import genai
 from .prompts import generate_test_prompt
@@ -13,32 +14,77 @@ if not api_key:
 model_name = os.getenv("MODEL_NAME", "gemini-2.5-flash")
 client = genai.Client(api_key=api_key)
 
+# Mỗi lời gọi Gemini chỉ sinh một nhóm nhỏ câu hỏi, các nhóm chạy song song
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "5"))
+# Trần số lời gọi Gemini đồng thời trong một worker
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+
+def _parse_questions(text: str) -> list:
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").replace("json", "", 1).strip()
+    data = json.loads(text)
+    if isinstance(data, dict):
+        return data.get("data", [])
+    if isinstance(data, list):
+        return data
+    return []
+
+
+async def generate_batch(batch_size: int, **kwargs) -> list:
+    """
+    Sinh một batch câu hỏi bằng async client.
+    Lỗi của batch nào chỉ ảnh hưởng batch đó: log lại và trả về [].
+    """
+    prompt = generate_test_prompt(num_questions=batch_size, **kwargs)
+    try:
+        async with _gemini_semaphore:
+            response = await client.aio.models.generate_content(
+                model=model_name,
+                contents=prompt
+            )
+        return _parse_questions(response.text)
+    except json.JSONDecodeError as e:
+        print(f"⚠️ Batch (size {batch_size}) trả về JSON lỗi: {e}")
+        return []
+    except Exception as e:
+        print(f"⚠️ Batch (size {batch_size}) lỗi khi gọi Gemini: {e}")
+        return []
+
 
 async def render_test(topic: str,
                       num_questions: int = 10,
                       question_types: list = None,
                       exam_type: str = "TOEIC",       # TOEIC | IELTS
                       score_range: str = None):       # e.g. "TOEIC 405-600", "IELTS 6.5-7.0"
-    prompt = generate_test_prompt(
-        topic=topic,
-        question_types=question_types,
-        num_questions=num_questions,
-        exam_type=exam_type,
-        score_range=score_range
-    )
+    # 1. Chia nhỏ yêu cầu, VD: 12 câu => [5, 5, 2]
+    batches = []
+    remaining = num_questions
+    while remaining > 0:
+        take = min(remaining, BATCH_SIZE)
+        batches.append(take)
+        remaining -= take
 
-    try:
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt
+    # 2. Chạy các batch song song
+    results = await asyncio.gather(*[
+        generate_batch(
+            batch_size=b,
+            topic=topic,
+            question_types=question_types,
+            exam_type=exam_type,
+            score_range=score_range
         )
-        text = response.text.strip()
+        for b in batches
+    ])
 
-        # Parse JSON trực tiếp (Gemini không trả markdown)
-        data = json.loads(text)
-        return data
+    # 3. Gộp kết quả
+    questions = []
+    for res in results:
+        questions.extend(res)
 
-    except json.JSONDecodeError:
-        raise ValueError(f"Không parse được JSON từ Gemini: {text}")
-    except Exception as e:
-        raise RuntimeError(f"Lỗi khi gọi Gemini: {str(e)}")
+    if not questions:
+        raise RuntimeError("Lỗi khi gọi Gemini: không batch nào sinh được câu hỏi")
+
+    return {"status": "success", "data": questions}